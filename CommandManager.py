@@ -1,12 +1,21 @@
+import asyncio
+import collections
+import functools
 import logging as command_logging
 import os
+import re
 import sys
+import time
 from logging.handlers import TimedRotatingFileHandler
 
 logger = command_logging.getLogger("CommandManager")
 
 
 def setup_logger():
+    # Called by main.py when it is run, not on import - the recognition worker imports main.py again, and should not
+    # open the log file a second time
+    if logger.handlers:
+        return
     if not os.path.exists("logs"):
         os.makedirs("logs")
 
@@ -21,7 +30,27 @@ def setup_logger():
     logger.setLevel(command_logging.DEBUG)
 
 
-setup_logger()
+class LatencyMetric:
+    # Keeps the latest measurements of a latency, in milliseconds
+    def __init__(self, name, size=100):
+        self.name = name
+        self.samples = collections.deque(maxlen=size)
+
+    def record(self, start, end=None):
+        if start is None:
+            return
+        if end is None:
+            end = time.perf_counter()
+        latency = (end - start)*1000
+        self.samples.append(latency)
+        logger.debug(self.name + ": " + str(round(latency, 2)) + " ms")
+
+    def summary(self):
+        if not self.samples:
+            return {"count": 0}
+        ordered = sorted(self.samples)
+        return {"count": len(ordered), "last": self.samples[-1], "min": ordered[0], "max": ordered[-1],
+                "mean": sum(ordered)/len(ordered), "median": ordered[len(ordered)//2]}
 
 
 class Command:
@@ -31,7 +60,74 @@ class Command:
         self.number = commandDict["number"] if "number" in commandDict else None
         self.debug_words = {"commandWord": commandDict["word"],
                             "distanceWord": commandDict["distance_word"] if "distance_word" in commandDict else None,
-                            "numberWord": commandDict["number_word"] if "number_word" in commandDict else None}
+                            "numberWord": commandDict["number_word"] if "number_word" in commandDict else None,
+                            # How sure we are that the words were the keywords, 1 being an exact match
+                            "commandConfidence": commandDict["confidence"] if "confidence" in commandDict else 1.0,
+                            "distanceConfidence": commandDict.get("distance_confidence"),
+                            "numberConfidence": commandDict.get("number_confidence")}
+        # When the text of the command was received, used for measuring the latency until a stop has stopped the motors
+        self.received_at = None
+        # When the command was put in the queue, used for measuring the latency until the motors start
+        self.queued_at = None
+
+    def getDriveDistance(self):
+        # The signed distance in centimeters of a forward or backward command, else None
+        if self.command == 1:
+            return self.number*self.distance
+        if self.command == -1:
+            return -(self.number*self.distance)
+        return None
+
+    def getTurnDegrees(self):
+        # The signed degrees of a turn command (right is positive), else None
+        return TURN_DEGREES.get(self.command)
+
+    def merge(self, other):
+        """
+        Merges this command with the command that comes right after it, so they can be run as one.
+
+        Drives in the same direction are summed and turns are added up, so two forward commands become one longer
+        drive, a left turn after a right turn cancels out, and two left turns become a 180 degree turn. A drive
+        forwards and one backwards are both kept - "to frem og to tilbage" is asked for as a move there and back.
+
+        :return: A list with the merged command, an empty list if the commands cancel out, or None if they can't be
+            merged.
+        """
+        distance = self.getDriveDistance()
+        other_distance = other.getDriveDistance()
+        if distance is not None and other_distance is not None:
+            if distance*other_distance <= 0:
+                return None
+            total = round(distance + other_distance, 6)
+            merged = {"command": 1 if total > 0 else -1, "distance": 1, "number": abs(total),
+                      "distance_word": self.joinWords(other, "distanceWord"),
+                      "number_word": self.joinWords(other, "numberWord")}
+            return [self.mergedWith(other, merged)]
+
+        degrees = self.getTurnDegrees()
+        other_degrees = other.getTurnDegrees()
+        if degrees is not None and other_degrees is not None:
+            # Between -180 and 180, as turning 270 degrees one way is turning 90 the other way
+            total = (degrees + other_degrees + 180) % 360 - 180
+            if total == 0:
+                return []
+            merged = {"command": TURN_COMMANDS[abs(total) if abs(total) == 180 else total]}
+            return [self.mergedWith(other, merged)]
+
+        return None
+
+    def mergedWith(self, other, commandDict):
+        commandDict["word"] = self.joinWords(other, "commandWord")
+        commandDict["confidence"] = min(self.debug_words["commandConfidence"], other.debug_words["commandConfidence"])
+        merged = Command(commandDict)
+        merged.received_at = self.received_at
+        # It has been waiting since the first of the commands was queued
+        merged.queued_at = self.queued_at if self.queued_at is not None else other.queued_at
+        return merged
+
+    def joinWords(self, other, key):
+        words = [word for word in (self.debug_words[key], other.debug_words[key]) if word]
+        return " + ".join(words) if words else None
 
     # GPIO kode:
     async def run(self, robot):
@@ -42,8 +138,8 @@ class Command:
             # Empty queue and stop robot
             robot.running = False
             robot.queue.empty()
-            # some stop stuff, to cancel a command that is currently running
-            robot.stop()
+            # Cancel the command that is currently running, which stops the motors right away
+            robot.cancel(self.received_at)
         else:
             robot.running = True
             # Forward command
@@ -68,117 +164,424 @@ class Command:
 
 
 class CommandQueue:
-    def __init__(self):
+    def __init__(self, coalesce=True):
         self.queue: [Command] = []
+        # Set whenever something is added, so whoever is waiting in get() wakes up right away
+        self.added = asyncio.Event()
+        # Whether to merge commands that come right after each other, so the robot stops and starts less
+        self.coalesce = coalesce
 
     def addToQueue(self, commandList: list):
-        self.queue = self.queue + commandList
+        queued_at = time.perf_counter()
+        for command in commandList:
+            command.queued_at = queued_at
+            # Stop commands skip everything else in the queue - everything before it is cancelled anyway
+            if command.command == 0:
+                self.queue = [command]
+                continue
+
+            merged = self.queue[-1].merge(command) if self.coalesce and self.queue else None
+            if merged is None:
+                self.queue.append(command)
+            else:
+                logger.debug("Merged commands " + str(self.queue[-1].command) + " and " + str(command.command) +
+                             " into " + str([merged_command.command for merged_command in merged]))
+                self.queue[-1:] = merged
+        if self.queue:
+            self.added.set()
+
+    def peek(self):
+        # The next command, without taking it out
+        return self.queue[0] if self.queue else None
+
+    async def get(self):
+        # Waits until there is a command in the queue, and takes it out
+        while not self.queue:
+            self.added.clear()
+            await self.added.wait()
+        return self.queue.pop(0)
 
     def empty(self):
         self.queue = []
 
 
+# The degrees of the turn commands, right being positive
+TURN_DEGREES = {2: 90, 3: -90, 4: 180}
+TURN_COMMANDS = {degrees: command for command, degrees in TURN_DEGREES.items()}
+
+# The words the parser knows
+COMMAND_KEYWORDS = {"stop": 0,
+                    "frem": 1,  # "kør": 1,
+                    "tilbage": -1, "baglæns": -1, "bagud": -1,
+                    "højre": 2,
+                    "venstre": 3}
+DISTANCE_KEYWORDS = {"millimeter": 0.1, "mm": 0.1, "centimeter": 1, "cm": 1,
+                     "meter": 100}
+NUMBER_KEYWORDS = {"en": 1, "1": 1,
+                   "to": 2, "2": 2,
+                   "tre": 3, "3": 3,
+                   "fire": 4,
+                   "fem": 5,
+                   "seks": 6,
+                   "syv": 7,
+                   "otte": 8,
+                   "ni": 9,
+                   "ti": 10,
+                   "elleve": 11,
+                   "tolv": 12,
+                   "tretten": 13,
+                   "fjorten": 14,
+                   "femten": 15,
+                   "seksten": 16,
+                   "sytten": 17,
+                   "atten": 18,
+                   "nitten": 19,
+                   "tyve": 20,
+                   "et": 1,
+                   "halv": 0.5, "halvanden": 1.5,
+                   "tredive": 30, "fyrre": 40, "halvtreds": 50, "tres": 60, "halvfjerds": 70, "firs": 80,
+                   "halvfems": 90,
+                   "hundrede": 100, "tusind": 1000,
+                   # Only for decimals, like "en komma nul fem"
+                   "nul": 0}
+
+# Danish writes 21-99 as one word, unit "og" tens - like "femogtyve"
+UNIT_WORDS = {"en": 1, "to": 2, "tre": 3, "fire": 4, "fem": 5, "seks": 6, "syv": 7, "otte": 8, "ni": 9}
+TENS_WORDS = {"tyve": 20, "tredive": 30, "fyrre": 40, "halvtreds": 50, "tres": 60, "halvfjerds": 70, "firs": 80,
+              "halvfems": 90}
+for unit_word, unit_value in UNIT_WORDS.items():
+    for tens_word, tens_value in TENS_WORDS.items():
+        NUMBER_KEYWORDS[unit_word + "og" + tens_word] = unit_value + tens_value
+
+# Numbers written with digits, like "35", "2.5" or "2,5"
+DIGITS_PATTERN = re.compile(r"^\d+([.,]\d+)?$")
+
+# Kinds of words
+WORD_OTHER = 0
+WORD_COMMAND = 1
+WORD_DISTANCE = 2
+WORD_NUMBER = 3
+
+# Lookup table from a word to its (kind, value), made once when the module is loaded
+VOCABULARY = {}
+for keywords, kind in ((NUMBER_KEYWORDS, WORD_NUMBER), (DISTANCE_KEYWORDS, WORD_DISTANCE),
+                       (COMMAND_KEYWORDS, WORD_COMMAND)):
+    for keyword, keyword_value in keywords.items():
+        VOCABULARY[keyword] = (kind, keyword_value)
+
+
+def editDistance(a, b):
+    # Levenshtein distance where swapping two letters next to each other also counts as one edit
+    previous_row = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous_row = previous_row, row
+        row = [i] + [0]*len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                row[j] = min(row[j], before[j - 2] + 1)
+    return row[len(b)]
+
+
+class FuzzyIndex:
+    """
+    Finds the keyword closest to a misrecognised word, like "tilbag" for "tilbage".
+
+    Every keyword is stored under all the ways of deleting up to a few of its letters, so the keywords close to a word
+    are found by looking up the deletions of the word, instead of comparing it to every keyword. Words of four letters
+    or less have to match exactly, as there are too many short Danish words one letter away from a keyword - like
+    "stor" from "stop". A match is only used if it is the only one that close, and not less sure than min_confidence.
+    """
+    def __init__(self, keywords: dict, ignored=(), min_confidence=0.8):
+        # Keyword -> value, where keywords with the same value are not ambiguous
+        self.keywords = dict(keywords)
+        # Common words that are too close to a keyword
+        self.ignored = set(ignored)
+        self.min_confidence = min_confidence
+        self.deletions = {}
+        for keyword in self.keywords:
+            for variant in self.deletionVariants(keyword, self.maxDistance(keyword)):
+                self.deletions.setdefault(variant, set()).add(keyword)
+
+    @staticmethod
+    def maxDistance(word):
+        if len(word) <= 4:
+            return 0
+        if len(word) <= 6:
+            return 1
+        return 2
+
+    @staticmethod
+    def deletionVariants(word, distance):
+        variants = {word}
+        edge = {word}
+        for _ in range(distance):
+            edge = {variant[:i] + variant[i + 1:] for variant in edge for i in range(len(variant))}
+            variants |= edge
+        return variants
+
+    def lookup(self, word):
+        """
+        Returns the closest keyword and the confidence (1 for an exact match), or (None, 0.0) if none is close enough.
+        """
+        if word in self.keywords:
+            return word, 1.0
+        max_distance = self.maxDistance(word)
+        if not max_distance or word in self.ignored:
+            return None, 0.0
+
+        candidates = set()
+        for variant in self.deletionVariants(word, max_distance):
+            candidates |= self.deletions.get(variant, set())
+
+        best, best_distance = [], max_distance + 1
+        for keyword in candidates:
+            distance = editDistance(word, keyword)
+            if distance > self.maxDistance(keyword) or distance > best_distance:
+                continue
+            if distance < best_distance:
+                best, best_distance = [], distance
+            best.append(keyword)
+        # Between keywords that mean different things, it is better to not guess
+        if not best or len({self.keywords[keyword] for keyword in best}) > 1:
+            return None, 0.0
+        keyword = min(best)
+        confidence = 1 - best_distance/max(len(word), len(keyword))
+        if confidence < self.min_confidence:
+            return None, 0.0
+        return keyword, confidence
+
+
+# Common words that are close enough to a keyword to be taken for it
+COMMON_WORDS = {"højere", "højde", "mener", "meder", "meler", "mester", "milliliter", "centiliter"}
+
+# A misheard number would change how far the robot drives without any error, and a misheard stop would empty the queue,
+# so numbers and stop only match exactly - like the short keywords, which are not in the index at all
+KEYWORD_INDEX = FuzzyIndex({keyword: (kind, value) for keyword, (kind, value) in VOCABULARY.items()
+                            if kind != WORD_NUMBER and not (kind == WORD_COMMAND and value == 0)},
+                           ignored=COMMON_WORDS)
+
+
+@functools.lru_cache(maxsize=4096)
+def lookupWord(word):
+    # The (kind, value, confidence) of a word - most words are heard again and again, so they are cached
+    if DIGITS_PATTERN.match(word):
+        number = float(word.replace(",", "."))
+        return WORD_NUMBER, int(number) if number.is_integer() else number, 1.0
+
+    if word in VOCABULARY:
+        kind, value = VOCABULARY[word]
+        return kind, value, 1.0
+    keyword, confidence = KEYWORD_INDEX.lookup(word)
+    if keyword is None:
+        return WORD_OTHER, None, 0.0
+    kind, value = VOCABULARY[keyword]
+    return kind, value, confidence
+
+
+def parseNumeral(words, tokens, start):
+    """
+    Reads the number that starts at start, which can be several words - like "fem og tyve", "to hundrede og fem",
+    "tusind og to hundrede", "en halv", "to og en halv" or "tre komma fem". Returns the value and the index after the
+    last word, or None if it is not a number.
+    """
+    count = len(words)
+
+    def number(index):
+        if index < count and tokens[index][0] == WORD_NUMBER:
+            return tokens[index][1]
+        return None
+
+    def simple(index):
+        # A single number word, "en halv", or unit "og" tens
+        value = number(index)
+        if value is None:
+            return None, index
+        if value == 1 and number(index + 1) == 0.5:
+            return 0.5, index + 2
+        if value in range(1, 10) and index + 2 < count and words[index + 1] == "og" and \
+                number(index + 2) in TENS_WORDS.values():
+            return value + number(index + 2), index + 3
+        return value, index + 1
+
+    def withMultiplier(index, multiplier, below):
+        # A number times the multiplier and the rest below it, like "to hundrede og fem" or "tusind og to hundrede"
+        value, end = below(index)
+        if value is None:
+            return None, index
+        if value != multiplier:
+            if number(end) != multiplier or value >= multiplier:
+                return value, end
+            value *= multiplier
+            end += 1
+        rest_start = end + 1 if end < count and words[end] == "og" else end
+        rest, rest_end = below(rest_start)
+        if rest is not None and rest < multiplier:
+            value += rest
+            end = rest_end
+        return value, end
+
+    def hundreds(index):
+        return withMultiplier(index, 100, simple)
+
+    value, end = withMultiplier(start, 1000, hundreds)
+    if value is None:
+        return None
+
+    # And a half, like "to og en halv" or "to og halv"
+    if end < count and words[end] == "og":
+        if number(end + 1) == 0.5:
+            value += 0.5
+            end += 2
+        elif number(end + 1) == 1 and number(end + 2) == 0.5:
+            value += 0.5
+            end += 3
+
+    # Decimals, like "tre komma fem", "en komma to fem" or "tre komma femogtyve". DanSpeech writes numbers as words,
+    # so "3,5" comes as these instead of as digits
+    elif end < count and words[end] == "komma" and float(value).is_integer():
+        decimals = ""
+        index = end + 1
+        while True:
+            digits, digits_end = simple(index)
+            # Either single digits, or one number below a hundred
+            if digits is None or not float(digits).is_integer() or not 0 <= digits < (100 if not decimals else 10):
+                break
+            decimals += str(int(digits))
+            index = digits_end
+            if digits >= 10:
+                break
+        if decimals:
+            value += float("0." + decimals)
+            end = index
+
+    return value, end
+
+
+def mergeNumerals(words, tokens):
+    # Joins the words of numbers written as several words into one word and token
+    merged_words = None
+    merged_tokens = None
+    copied = 0
+    index = 0
+    count = len(words)
+    while index < count - 1:
+        # A number can only go on if it is followed by another number, "og" or "komma"
+        if tokens[index][0] != WORD_NUMBER or (tokens[index + 1][0] != WORD_NUMBER and words[index + 1] != "og" and
+                                               words[index + 1] != "komma"):
+            index += 1
+            continue
+        numeral = parseNumeral(words, tokens, index)
+        end = numeral[1]
+        if end - index > 1:
+            # Most transcripts have no numbers of several words, so the lists are only copied when there is one
+            if merged_words is None:
+                merged_words = []
+                merged_tokens = []
+            merged_words.extend(words[copied:index])
+            merged_tokens.extend(tokens[copied:index])
+            merged_words.append(" ".join(words[index:end]))
+            merged_tokens.append((WORD_NUMBER, numeral[0], min(token[2] for token in tokens[index:end]
+                                                               if token[0] == WORD_NUMBER)))
+            copied = end
+        index = end
+
+    if merged_words is None:
+        return words, tokens
+    merged_words.extend(words[copied:])
+    merged_tokens.extend(tokens[copied:])
+    return merged_words, merged_tokens
+
+
+def unlinkWord(previous, following, index):
+    if previous[index] != -1:
+        following[previous[index]] = following[index]
+    if following[index] != -1:
+        previous[following[index]] = previous[index]
+
+
+def searchWords(tokens, previous, following, index, kind, max_search=2):
+    """
+    Looks for a word of a kind up to max_search words before index, and then after it. Commands take up a place,
+    but are skipped. The word found is unlinked and its index returned, or -1 if there was none.
+    """
+    for links in (previous, following):
+        found = links[index]
+        for _ in range(max_search):
+            if found == -1:
+                break
+            if tokens[found][0] == kind:
+                unlinkWord(previous, following, found)
+                return found
+            found = links[found]
+    return -1
+
+
 class CommandParser:
     def __init__(self, text: str):
+        received_at = time.perf_counter()
         self.raw_text = text
         self.commands = []
-        logger.debug("Raw text command: " + self.raw_text)
+        logger.debug("Raw text command: %s", self.raw_text)
         self.textToCommands()
-        logger.debug("Commands: " + str(self.commands))
+        for command in self.commands:
+            command.received_at = received_at
+        logger.debug("Commands: %s", self.commands)
 
     def textToCommands(self):
-        # TODO: Better text to command parser
-        command_keywords = {"stop": 0,
-                            "frem": 1,  # "kør": 1,
-                            "tilbage": -1, "baglæns": -1, "bagud": -1,
-                            "højre": 2,
-                            "venstre": 3}
-        distance_keywords = {"millimeter": 0.1, "centimeter": 1,
-                             "meter": 100}
-        number_keywords = {"en": 1, "1": 1,
-                           "to": 2, "2": 2,
-                           "tre": 3, "3": 3,
-                           "fire": 4,
-                           "fem": 5,
-                           "seks": 6,
-                           "syv": 7,
-                           "otte": 8,
-                           "ni": 9,
-                           "ti": 10,
-                           "elleve": 11,
-                           "tolv": 12,
-                           "tretten": 13,
-                           "fjorten": 14,
-                           "femten": 15,
-                           "seksten": 16,
-                           "sytten": 17,
-                           "atten": 18,
-                           "nitten": 19,
-                           "tyve": 20}
-
-        text_list = self.raw_text.split(" ")
-
-        i = 0
-        while True:
-            if i >= len(text_list):
-                break
+        """
+        Turns the text into commands in a single pass over the words.
+
+        Only the command words are visited. Distance and number words are searched for up to two words before a
+        command, and then up to two words after it. Words that have been used by a command (and commands that have
+        been handled) are unlinked from a linked list of the words, so the next searches skip them.
+        """
+        words = self.raw_text.lower().split(" ")
+        tokens = [lookupWord(word) for word in words]
+        words, tokens = mergeNumerals(words, tokens)
+
+        # Only the commands have to be visited, the other words are found by searching around them
+        positions = [index for index, token in enumerate(tokens) if token[0] == WORD_COMMAND]
+        if not positions:
+            return
+
+        # Doubly linked list of the words that have not been used yet, -1 being the end
+        count = len(words)
+        previous = list(range(-1, count - 1))
+        following = list(range(1, count + 1))
+        following[-1] = -1
+
+        skipped = -1
+        for current in positions:
+            # The word right after a command is not looked at
+            if current == skipped:
+                continue
+
+            value = tokens[current][1]
+            if value == 0:
+                self.commands.append(Command({"command": 0, "word": words[current],
+                                              "confidence": tokens[current][2]}))
+                unlinkWord(previous, following, current)
+                continue
+
+            # set defaults
+            command = {"command": value, "word": words[current], "confidence": tokens[current][2],
+                       "distance": 100, "distance_word": None,
+                       "number": 1, "number_word": None}
+
+            found = searchWords(tokens, previous, following, current, WORD_DISTANCE)
+            if found != -1:
+                command["distance"] = tokens[found][1]
+                command["distance_word"] = words[found]
+                command["distance_confidence"] = tokens[found][2]
+            found = searchWords(tokens, previous, following, current, WORD_NUMBER)
+            if found != -1:
+                command["number"] = tokens[found][1]
+                command["number_word"] = words[found]
+                command["number_confidence"] = tokens[found][2]
 
-            current_word = text_list[i].lower()
-            # If our word is in commands
-            if current_word in command_keywords:
-                logger.debug(text_list)
-                logger.debug("Current i: " + str(i) + " - " + str(current_word))
-                if command_keywords[current_word] == 0 or command_keywords[current_word] == 100:
-                    self.commands.append(Command({"command": command_keywords[current_word], "word": current_word}))
-                    text_list.pop(i)
-                    # do not increment i
-                    continue
-
-                # set defaults
-                command = {"command": command_keywords[current_word], "word": current_word,
-                           "distance": 100, "distance_word": None,
-                           "number": 1, "number_word": None}
-
-                def searchAround(keyword_list: dict, max_search: int = 2, negative=False):
-                    for y in range(1, max_search + 1):
-                        number = None
-                        if negative and (i - y) >= 0:
-                            number = i - y
-                        elif not negative and (i + y) < len(text_list):
-                            number = i + y
-
-                        if isinstance(number, int):
-                            current_word = text_list[number].lower()
-                            if current_word in command_keywords:
-                                continue
-                            if current_word in keyword_list:
-                                text_list.pop(number)
-                                return current_word
-                    return None
-
-                # Search around word for distance keyword
-                search_word = searchAround(distance_keywords, negative=True)
-                if search_word:
-                    command["distance"] = distance_keywords[search_word]
-                    command["distance_word"] = search_word
-                    i -= 1
-                else:
-                    search_word = searchAround(distance_keywords, negative=False)
-                    if search_word:
-                        command["distance"] = distance_keywords[search_word]
-                        command["distance_word"] = search_word
-                # Search around for number keyword
-                search_word = searchAround(number_keywords, negative=True)
-                if search_word:
-                    command["number"] = number_keywords[search_word]
-                    command["number_word"] = search_word
-                    i -= 1
-                else:
-                    search_word = searchAround(number_keywords, negative=False)
-                    if search_word:
-                        command["number"] = number_keywords[search_word]
-                        command["number_word"] = search_word
-
-                self.commands.append(Command(command))
-                text_list.pop(i)
-            i += 1
+            self.commands.append(Command(command))
+            unlinkWord(previous, following, current)
+            skipped = following[current]
@@ -1,8 +1,12 @@
 import asyncio
+import bisect
+import collections
+import json
 import logging
+import os
 import math
 import threading
-from time import sleep
+import time
 from gpiozero import Motor, Servo, DigitalInputDevice
 import CommandManager
 
@@ -12,88 +16,294 @@ wheel_diameter = 7  # centimeters
 
 
 class Robot:
-    def __init__(self, leftDC_args, rightDC_args, servo_args):
+    def __init__(self, leftDC_args, rightDC_args, servo_args, pin_factory=None, calibration_file="calibration.json",
+                 motion_log=None):
+        # The pin factory decides what hardware is used - None for the default GPIO pins, or a gpiozero MockFactory
+        # for a simulated robot (see SimulationManager)
         self.leftDC = DCMotor(forward_pin=leftDC_args["motor_pos"], backward_pin=leftDC_args["motor_neg"],
                               encoder_pins={"enc_a": leftDC_args["encoder_a"], "enc_b": leftDC_args["encoder_b"]},
-                              pwm_pin=leftDC_args["pwm_pin"])
+                              pwm_pin=leftDC_args["pwm_pin"],
+                              encoder_invert=leftDC_args.get("encoder_invert", False), pin_factory=pin_factory)
         self.rightDC = DCMotor(forward_pin=rightDC_args["motor_pos"], backward_pin=rightDC_args["motor_neg"],
                                encoder_pins={"enc_a": rightDC_args["encoder_a"], "enc_b": rightDC_args["encoder_b"]},
-                               pwm_pin=rightDC_args["pwm_pin"])
-        self.frontServo = ServoMotor(servo_pin=servo_args["servo_pin"])
+                               pwm_pin=rightDC_args["pwm_pin"],
+                               encoder_invert=rightDC_args.get("encoder_invert", False), pin_factory=pin_factory)
+        self.frontServo = ServoMotor(servo_pin=servo_args["servo_pin"], pin_factory=pin_factory)
 
-        # How many centimeters to turn the wheels when turning around by 90 degrees
-        self.turn_distance = 25
         # How much the front wheels should tilt when turning
         self.turn_degrees = 25
-
-        # Make new command queue for robot
-        self.queue = CommandManager.CommandQueue()
+        # How far the wheels have to go to turn - with the parameters from calibrate.py, if it has been run
+        self.turn_model = TurnModel.load(calibration_file)
+        # Where the encoder distances of every finished move are written, for calibrate.py - off unless a file is given,
+        # since it is only needed when calibrating
+        self.motion_log = motion_log
+        # How much of the end of a move the servo may use to get ready for the next command, from 0 to 1
+        self.servo_overlap = 0.25
+        # If the servo has moved for the next command during the current move, which then did not end straight
+        self.servo_moved_early = False
+
+        # Streaming velocity control - the robot stops if no new velocity has come within the timeout, in seconds
+        self.velocity_mode = False
+        self.velocity_timeout = 0.25
+        self.velocity_deadline = 0
+        self.velocity_watchdog = None
 
         self.running = True
         self.current_command = None
+        # The task running the current command, so it can be cancelled by a stop
+        self.command_task = None
+
+        # Time from a command being queued until the motors start moving for it
+        self.start_latency = CommandManager.LatencyMetric("Enqueue to motor latency")
+        # Time from a stop command being received until the motors are off
+        self.stop_latency = CommandManager.LatencyMetric("Stop latency")
 
         # Get a new loop that we can use for the looping task
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
 
-        # Start the check for command loop
+        # Make new command queue for robot - after the loop is set, as the queue waits on it
+        self.queue = CommandManager.CommandQueue()
+
+        # Speed control for both DC motors
+        self.controller = MotionController(self.leftDC, self.rightDC)
+
+        # Start the check for command loop and the speed control loop
         asyncio.ensure_future(self.run())
+        asyncio.ensure_future(self.controller.run())
 
     async def run(self):
-        # Main loop for checking for commands and running them
+        # Main loop for running commands - waits for the next one to be put in the queue
         while True:
-            # If any commands in queue
-            if self.queue.queue:
-                next_command: CommandManager.Command = self.queue.queue[0]
-                self.queue.queue.pop(0)
-                logger.debug("Running command: " + str(next_command.command))
-                await next_command.run(self)
-            else:
-                await asyncio.sleep(1)
+            next_command: CommandManager.Command = await self.queue.get()
+            logger.debug("Running command: " + str(next_command.command))
+            # A command takes over from streaming velocities
+            if self.velocity_mode:
+                self.stopVelocity()
+            # Run in its own task, so a stop can cancel it - wait() does not raise if it was
+            self.command_task = self.loop.create_task(next_command.run(self))
+            await asyncio.wait([self.command_task])
+            if self.command_task.cancelled():
+                logger.info("Command cancelled: " + str(next_command.command))
+            elif self.command_task.exception():
+                logger.error("Command failed: " + repr(self.command_task.exception()))
+            self.command_task = None
+            self.current_command = None
 
     async def drive(self, centimeters=100):
-        # TODO maybe these functions should be async
         if not self.frontServo.is_centered():
             self.frontServo.center()
 
         # Wait for servo to center
-        while self.frontServo.is_running():
-            await asyncio.sleep(0.2)
+        await self.frontServo.settled()
+
+        self.motorsStarted()
+        self.servo_moved_early = False
 
         # Drive forwards or backwards depending on the distance
         if centimeters > 0:
-            self.rightDC.forward(centimeters)
-            self.leftDC.forward(centimeters)
+            moves = [self.rightDC.forward(centimeters), self.leftDC.forward(centimeters)]
         else:
             # It's already minus, so minus it again and get plus
-            self.rightDC.backward(-centimeters)
-            self.leftDC.backward(-centimeters)
+            moves = [self.rightDC.backward(-centimeters), self.leftDC.backward(-centimeters)]
+
+        self.planNextServo(self.leftDC, abs(centimeters))
 
-        while self.isRunning():
-            await asyncio.sleep(0.2)
+        # Wait for both motors to reach their distance
+        await self.waitForMoves(moves)
+        self.recordMotion({"type": "drive", "centimeters": centimeters})
 
     async def turn(self, degrees=90):
-        # Over 0 = right, else turn left
-        if degrees > 0:
-            self.frontServo.turn(-self.turn_degrees)
-        else:
-            self.frontServo.turn(self.turn_degrees)
+        self.frontServo.turn(self.servoDegrees(degrees))
 
         # Wait for servo to turn
-        while self.frontServo.is_running():
-            await asyncio.sleep(0.2)
-
-        # TODO: CALCULATE DISTANCE TO TURN FOR AMOUNT OF DEGREES
-        # The distance that the wheels in the back travel to turn, is what we use together with degrees to variate the degrees at which we turn
-        if degrees > 0:
-            self.rightDC.backward(self.turn_distance)
-            self.leftDC.forward(self.turn_distance)
+        await self.frontServo.settled()
+
+        self.motorsStarted()
+        self.servo_moved_early = False
+
+        # Each back wheel drives its own arc around the point the robot turns around, the outer wheel at the normal
+        # speed and the inner wheel slower, so they finish together
+        distances = self.turn_model.wheelDistances(degrees, self.turn_degrees)
+        longest = max(abs(distance) for distance in distances)
+        moves = []
+        for motor, distance in zip((self.leftDC, self.rightDC), distances):
+            if abs(distance) < 0.1:
+                continue
+            speed = motor.speed*abs(distance)/longest
+            if distance > 0:
+                moves.append(motor.forward(distance, speed=speed))
+            else:
+                moves.append(motor.backward(-distance, speed=speed))
+            if abs(distance) == longest:
+                self.planNextServo(motor, longest)
+
+        await self.waitForMoves(moves)
+        self.recordMotion({"type": "turn", "degrees": degrees, "servo_degrees": self.turn_degrees})
+
+    async def waitForMoves(self, moves):
+        # Both wheels are stopped if one of them fails, so they are all done soon after
+        results = await asyncio.gather(*moves, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            # A wheel is stuck or counts the wrong way, so the commands after this one would go wrong as well
+            self.queue.empty()
+            raise errors[0]
+
+    def servoDegrees(self, degrees):
+        # Over 0 = right, else turn left - the servo turns the other way
+        return -self.turn_degrees if degrees > 0 else self.turn_degrees
+
+    def commandServoDegrees(self, command):
+        # Where the servo has to be for a command, or None if it does not matter
+        degrees = command.getTurnDegrees()
+        if degrees is not None:
+            return self.servoDegrees(degrees)
+        if command.getDriveDistance() is not None:
+            return 0
+        return None
+
+    def planNextServo(self, motor, distance):
+        """
+        Gets the servo ready for the next command in the queue while the end of the current move is driven, so the
+        next command does not have to wait for it.
+
+        The servo starts moving when the wheel has as far left as it drives in the time the servo needs, but never
+        before the last servo_overlap of the move, so the front wheel only goes off course for the very end of it.
+        """
+        if not self.servo_overlap:
+            return
+        servo = self.frontServo
+        # The next command is not known yet, so leave time for the farthest the servo can have to go
+        travel = max(abs(servo.target_angle - degrees) for degrees in (0, self.turn_degrees, -self.turn_degrees))
+        seconds = travel/servo.slew_rate + servo.settle_time
+        tail = motor.profile.tailDistance(seconds) if motor.profile else motor.target_speed*seconds
+        tail = min(tail, distance*self.servo_overlap)
+        # The encoder runs the callback on its own thread
+        command = self.current_command
+        motor.encoder.addTarget(motor.encoder.distanceToSignals(distance - tail),
+                                lambda: self.loop.call_soon_threadsafe(self.prepareServo, command))
+
+    def prepareServo(self, command):
+        # Only while the command is still running, the next one has to be waited for as normal
+        next_command = self.queue.peek()
+        if next_command is None or not self.running or self.current_command is not command:
+            return
+        degrees = self.commandServoDegrees(next_command)
+        if degrees is not None and degrees != self.frontServo.target_angle:
+            self.frontServo.turn(degrees)
+            self.servo_moved_early = True
+
+    def recordMotion(self, motion):
+        # Adds the distances the encoders measured for a finished move to the motion log
+        if not self.motion_log:
+            return
+        motion["left"] = round(self.leftDC.encoder.getDistance()["cm"]*self.leftDC.encoder.direction, 2)
+        motion["right"] = round(self.rightDC.encoder.getDistance()["cm"]*self.rightDC.encoder.direction, 2)
+        # The end of the move was driven with the servo on its way to the next command, so it is not a clean move
+        motion["servo_overlap"] = self.servo_moved_early
+        try:
+            directory = os.path.dirname(self.motion_log)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.motion_log, "a", encoding="UTF-8") as file:
+                file.write(json.dumps(motion) + "\n")
+        except OSError as e:
+            logger.error("Could not write to the motion log: " + str(e))
+
+    def setVelocity(self, linear, angular):
+        """
+        Drives continuously at the given velocity, for streaming control from the client. Nothing is queued - the
+        wheels just get new target speeds, which the speed control loop follows. If no new velocity comes within
+        velocity_timeout seconds, the robot stops.
+
+        :param linear: Forward speed in centimeters per second, negative for backwards.
+        :param angular: Turn speed in degrees per second, positive for right.
+        """
+        if not self.velocity_mode:
+            # Streaming takes over from the commands
+            self.queue.empty()
+            self.cancel()
+            self.velocity_mode = True
+            self.leftDC.failed = self.rightDC.failed = False
+
+        if self.leftDC.failed or self.rightDC.failed:
+            if linear or angular:
+                # A wheel has been stopped for being stuck or counting the wrong way during this stream, so keep still
+                # until the driver lets go
+                self.velocity_deadline = time.perf_counter() + self.velocity_timeout
+                return
+            self.leftDC.failed = self.rightDC.failed = False
+
+        # Right is positive, so the left wheel goes faster when turning right - in encoder centimeters per second
+        difference = math.radians(angular)*self.turn_model.track_width/2
+        scale = self.turn_model.wheel_scale
+        left, right = (linear + difference)/scale, (linear - difference)/scale
+        # Keep the curve when a wheel would have to go faster than it can
+        fastest = max(abs(left), abs(right))
+        max_speed = min(self.leftDC.max_speed, self.rightDC.max_speed)
+        if fastest > max_speed:
+            left, right = left*max_speed/fastest, right*max_speed/fastest
+        self.leftDC.setVelocity(left)
+        self.rightDC.setVelocity(right)
+
+        # Point the front wheel along the curve - all the way when turning on the spot
+        if angular == 0:
+            degrees = 0
+        elif abs(linear) < 1:
+            degrees = self.turn_degrees
         else:
-            self.rightDC.forward(self.turn_distance)
-            self.leftDC.backward(self.turn_distance)
+            degrees = min(self.turn_model.servoDegrees(abs(linear/math.radians(angular))), self.turn_degrees)
+        # The servo turns the other way of the robot, and the curve flips when going backwards
+        if (angular > 0) == (linear > -1):
+            degrees = -degrees
+        self.frontServo.turn(degrees)
+
+        self.velocity_deadline = time.perf_counter() + self.velocity_timeout
+        if self.velocity_watchdog is None:
+            self.velocity_watchdog = self.loop.call_later(self.velocity_timeout, self.checkVelocity)
+
+    def checkVelocity(self):
+        # The watchdog only wakes up once per timeout, and goes back to sleep if a velocity has come since
+        if not self.velocity_mode:
+            # Already stopped
+            self.velocity_watchdog = None
+            return
+        remaining = self.velocity_deadline - time.perf_counter()
+        if remaining > 0:
+            self.velocity_watchdog = self.loop.call_later(remaining, self.checkVelocity)
+            return
+        self.velocity_watchdog = None
+        logger.warning("No velocity received for " + str(self.velocity_timeout) + " seconds - stopping")
+        self.stopVelocity()
+
+    def stopVelocity(self):
+        self.velocity_mode = False
+        self.leftDC.failed = self.rightDC.failed = False
+        if self.velocity_watchdog:
+            self.velocity_watchdog.cancel()
+            self.velocity_watchdog = None
+        self.stop()
+
+    def motorsStarted(self):
+        # Record the latency for the current command, once
+        if self.current_command and self.current_command.queued_at:
+            self.start_latency.record(self.current_command.queued_at)
+            self.current_command.queued_at = None
 
-        while self.isRunning():
-            await asyncio.sleep(0.2)
+    def cancel(self, received_at=None):
+        """
+        Stops the motors, and cancels the command that is running, so it stops waiting for its moves.
+
+        :param received_at: When the stop was received, to measure the latency until the motors are off.
+        """
+        self.stop()
+        self.stop_latency.record(received_at)
+
+        # A stop command that is run from the queue is the running command itself
+        task = self.command_task
+        if task and not task.done() and task is not asyncio.current_task():
+            task.cancel()
 
     def isRunning(self):
         return bool(self.leftDC.is_running() or self.rightDC.is_running() or self.frontServo.is_running())
@@ -102,43 +312,377 @@ class Robot:
         self.leftDC.stop()
         self.rightDC.stop()
         self.frontServo.stop()
+        # A stop also ends streaming, then the watchdog sees that there is nothing to stop
+        self.velocity_mode = False
+
+
+class TurnModel:
+    """
+    Kinematic model of how far the back wheels have to go to turn the robot.
+
+    With the front wheel at an angle, the robot turns around a point on the line through the back wheels, which is
+    wheelbase/tan(angle) from the middle of them. Each back wheel then drives an arc around that point, the outer one
+    half the track width further out, and the inner one half the track width further in - backwards, if the point is
+    between the wheels.
+
+    Distances are in centimeters. wheel_scale is how far the robot actually goes per centimeter that the encoders
+    measure, as the real wheels are not exactly wheel_diameter.
+    """
+    def __init__(self, track_width=15, wheelbase=15, wheel_scale=1.0):
+        self.track_width = track_width
+        self.wheelbase = wheelbase
+        self.wheel_scale = wheel_scale
+
+    def pivotOffset(self, servo_degrees):
+        # Distance from the middle of the back wheels to the point the robot turns around
+        servo_degrees = abs(servo_degrees)
+        if servo_degrees >= 90:
+            return 0.0
+        if servo_degrees == 0:
+            return math.inf
+        return self.wheelbase/math.tan(math.radians(servo_degrees))
+
+    def servoDegrees(self, pivot_offset):
+        # The angle of the front wheel that turns the robot around a point pivot_offset from the middle
+        return math.degrees(math.atan2(self.wheelbase, pivot_offset))
+
+    def wheelDistances(self, degrees, servo_degrees):
+        """
+        The distances the wheels have to drive, as measured by the encoders, to turn by degrees (right is positive)
+        with the front wheel at servo_degrees.
+
+        :return: The signed distances of the left and right wheel - negative for backwards.
+        """
+        angle = abs(math.radians(degrees))
+        offset = self.pivotOffset(servo_degrees)
+        outer = angle*(offset + self.track_width/2)/self.wheel_scale
+        inner = angle*(offset - self.track_width/2)/self.wheel_scale
+        # Turning right, the left wheel is on the outside
+        if degrees > 0:
+            return outer, inner
+        return inner, outer
+
+    @classmethod
+    def fit(cls, drives, turns, model=None):
+        """
+        Fits the parameters to moves that have been measured, with least squares.
+
+        :param drives: (encoder centimeters, actual centimeters) of drives, used for the wheel scale.
+        :param turns: (servo degrees, left encoder centimeters, right encoder centimeters, actual degrees) of turns.
+        :param model: The model to take the parameters from that can't be fitted, for example without any drives.
+        """
+        model = model or cls()
+        wheel_scale = model.wheel_scale
+        if drives:
+            squares = sum(measured*measured for measured, _ in drives)
+            if squares:
+                wheel_scale = sum(measured*actual for measured, actual in drives)/squares
+
+        track_width = model.track_width
+        wheelbase = model.wheelbase
+        if turns:
+            # The difference between the wheels is the angle times the track width, right being positive
+            angles = [math.radians(actual) for _, _, _, actual in turns]
+            differences = [(left - right)*wheel_scale for _, left, right, _ in turns]
+            squares = sum(angle*angle for angle in angles)
+            if squares:
+                track_width = sum(difference*angle for difference, angle in zip(differences, angles))/squares
+
+            # The middle of the wheels goes the angle times the pivot offset, which is wheelbase/tan(servo angle)
+            middles = [(left + right)/2*wheel_scale for _, left, right, _ in turns]
+            factors = [abs(angle)/math.tan(math.radians(abs(servo))) if 0 < abs(servo) < 90 else 0
+                       for (servo, _, _, _), angle in zip(turns, angles)]
+            squares = sum(factor*factor for factor in factors)
+            if squares:
+                wheelbase = max(0.0, sum(middle*factor for middle, factor in zip(middles, factors))/squares)
+
+        return cls(track_width=track_width, wheelbase=wheelbase, wheel_scale=wheel_scale)
+
+    def toDict(self):
+        return {"track_width": self.track_width, "wheelbase": self.wheelbase, "wheel_scale": self.wheel_scale}
+
+    def save(self, path):
+        with open(path, "w", encoding="UTF-8") as file:
+            json.dump(self.toDict(), file, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        # The default parameters if there is no calibration
+        if not path or not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, encoding="UTF-8") as file:
+                return cls(**json.load(file))
+        except (OSError, ValueError, TypeError) as e:
+            logger.error("Could not load the calibration from " + path + ": " + str(e))
+            return cls()
+
+
+class MotionController:
+    """
+    Fixed rate speed control loop for the two DC motors.
+
+    Every step it reads the speed of each wheel from its encoder, and runs the wheel's PID controller to get the
+    motor power needed for its target speed - the cruise speed for a move, or the velocity it was given. When both
+    wheels are moving, their targets are cross-coupled, so the wheel that is ahead (as a fraction of its move) slows
+    down and the one behind speeds up.
+
+    A wheel that stalls, or whose encoder counts the wrong way, is stopped together with the other one - see
+    :meth:`DCMotor.checkProgress`.
+    """
+    def __init__(self, left, right, rate=50, sync_gain=5, lookahead=0.045):
+        self.left = left
+        self.right = right
+        self.motors = [left, right]
+        self.period = 1/rate
+        # Seconds that the speed profiles are looked ahead, for the delay of the speed measurement and of the loop
+        self.lookahead = lookahead
+        # How much to change the target speeds per fraction of the move that the wheels are apart
+        self.sync_gain = sync_gain
+        self.max_correction = 0.5
+        self.running = False
+
+    async def run(self):
+        self.running = True
+        last = time.perf_counter()
+        next_step = last
+        while self.running:
+            next_step += self.period
+            await asyncio.sleep(max(0.0, next_step - time.perf_counter()))
+            now = time.perf_counter()
+            # If we fell behind, do not try to catch up with a burst of steps
+            if now - next_step > self.period:
+                next_step = now
+            self.step(now - last)
+            last = now
+
+    def stop(self):
+        self.running = False
+
+    def step(self, dt):
+        if dt <= 0:
+            return
+
+        # Cross-coupling - positive when the left wheel is ahead
+        correction = 0
+        if self.left.direction and self.right.direction:
+            correction = self.sync_gain*(self.left.getProgress() - self.right.getProgress())
+            correction = min(max(correction, -self.max_correction), self.max_correction)
+
+        if not all(motor.checkProgress() for motor in self.motors if motor.direction):
+            # Driving on with one wheel would only take the robot off course
+            for motor in self.motors:
+                motor.stop()
+            return
+
+        for motor in self.motors:
+            if not motor.direction:
+                continue
+            if motor.profile:
+                # Where the wheel will be by the time the power has an effect
+                position = motor.encoder.getDistance()["cm"] + max(motor.encoder.getSpeed(), 0)*self.lookahead
+                motor.target_speed = motor.profile.speedAt(position)
+            target = motor.target_speed
+            target *= (1 - correction) if motor is self.left else (1 + correction)
+            motor.pid.setpoint = target
+            motor.setPower(motor.pid.update(motor.encoder.getSpeed(), dt, feedforward=target/motor.max_speed))
+
+
+class MotionProfile:
+    """
+    Trapezoidal speed profile of a move. The speed ramps up from start_speed to the cruise speed, and down again to
+    end_speed right at the end of the move, so the wheel is slow when it is stopped and does not overshoot or slip.
+    Short moves ramp down before they get to the cruise speed.
+
+    The speed is looked up by how far the wheel has gotten rather than by time, so a wheel that is behind is not
+    told to slow down before it actually gets near the end.
+    """
+    def __init__(self, distance, cruise_speed, acceleration, start_speed=0.0, end_speed=0.0):
+        # Centimeters, centimeters per second and centimeters per second squared
+        self.distance = distance
+        self.cruise_speed = cruise_speed
+        self.acceleration = acceleration
+        self.start_speed = min(start_speed, cruise_speed)
+        self.end_speed = min(end_speed, cruise_speed)
+
+    def speedAt(self, position):
+        remaining = max(self.distance - position, 0.0)
+        accelerating = math.sqrt(self.start_speed**2 + 2*self.acceleration*max(position, 0.0))
+        braking = math.sqrt(self.end_speed**2 + 2*self.acceleration*remaining)
+        return min(self.cruise_speed, accelerating, braking)
+
+    def tailDistance(self, seconds):
+        # How far the wheel goes in the last seconds of the move, ramping down from the cruise speed
+        ramp_seconds = (self.cruise_speed - self.end_speed)/self.acceleration
+        if seconds <= ramp_seconds:
+            distance = self.end_speed*seconds + self.acceleration*seconds**2/2
+        else:
+            ramp_distance = (self.cruise_speed**2 - self.end_speed**2)/(2*self.acceleration)
+            distance = ramp_distance + self.cruise_speed*(seconds - ramp_seconds)
+        return min(distance, self.distance)
 
 
 class PIDController:
-    def __init__(self, encoder, pwm_pin):
+    def __init__(self, encoder, pwm_pin, kp=0.01, ki=0.04, kd=0.0005, output_limits=(0.0, 1.0)):
         # Define pins
         self.encoder = encoder
         self.output_pin = pwm_pin
 
+        # Gains for the speed error in centimeters per second, the output is the motor power
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.output_limits = output_limits
+
+        # Target speed in centimeters per second
+        self.setpoint = 0
+        self.integral = 0
+        self.last_error = None
+        self.output = 0
+
+    def reset(self):
+        self.integral = 0
+        self.last_error = None
+        self.output = 0
+
+    def update(self, measurement, dt, feedforward=0.0):
+        error = self.setpoint - measurement
+        derivative = 0 if self.last_error is None else (error - self.last_error)/dt
+        self.last_error = error
+
+        integral = self.integral + error*dt
+        output = feedforward + self.kp*error + self.ki*integral + self.kd*derivative
+
+        # Anti-windup - stop integrating while the output is saturated, unless the error brings it back
+        low, high = self.output_limits
+        if low < output < high or (output >= high and error < 0) or (output <= low and error > 0):
+            self.integral = integral
+
+        self.output = min(max(output, low), high)
+        return self.output
+
 
 class Encoder:
-    def __init__(self, pins):
+    # Position change for a move from one state of (A, B) to another, indexed by old_state*4 + new_state.
+    # Invalid moves (both pins changing at once, meaning a signal was missed) count as 0
+    QUADRATURE_STEPS = (0, -1, 1, 0,
+                        1, 0, 0, -1,
+                        -1, 0, 0, 1,
+                        0, 1, -1, 0)
+
+    def __init__(self, pins, samples=16, speed_window=0.05, invert=False, pin_factory=None):
         # Define pins
-        self.outputA = DigitalInputDevice(pins["enc_a"])
-        self.outputB = DigitalInputDevice(pins["enc_b"])
+        self.outputA = DigitalInputDevice(pins["enc_a"], pin_factory=pin_factory)
+        self.outputB = DigitalInputDevice(pins["enc_b"], pin_factory=pin_factory)
 
-        # Variable to increase as we go
+        # The motors are mounted as mirror images, so on one of them A and B can come in the other order going forwards
+        self.polarity = -1 if invert else 1
+        # Signed position, increases going forwards and decreases going backwards
         self.position = 0
+        self.state = self._readState()
 
-        # Variable to put current position in at start of tracking
+        # Variable to put current position in at start of tracking, and the direction we are tracking in
         self.old_position = self.position
+        self.direction = 1
 
-        # Variables for signal distance
-        self.signals_per_rotation = 1350  # Measured by running a motor and stopping it at certain points, until it turned 360 degrees
-        self.signal_centimeter_ratio = ((wheel_diameter*math.pi)/self.signals_per_rotation)  # Get circumference of wheel, and get the ratio between signals from encoder and distance
+        # Callbacks to run when the position change reaches a number of signals, sorted as [signals, callback]
+        self.targets = []
+        self.next_target = math.inf
+        self.targets_lock = threading.Lock()
 
-        # Listen for changes
-        self.outputB.when_activated = self._increment
-        self.outputB.when_deactivated = self._increment
+        # The time and position every time the speed has been read, for estimating the speed
+        self.samples = collections.deque(maxlen=samples)
+        # How far back the speed is measured over, in seconds
+        self.speed_window = speed_window
 
-    def _increment(self):
-        self.position += 1
+        # Variables for signal distance
+        # Measured by running a motor and stopping it at certain points, until it turned 360 degrees - 1350 counting
+        # both edges of B, so 2700 counting all edges of both A and B
+        self.signals_per_rotation = 2700
+        self.signal_centimeter_ratio = ((wheel_diameter*math.pi)/self.signals_per_rotation)  # Get circumference of wheel, and get the ratio between signals from encoder and distance
 
-    def startDistanceTracking(self):
+        # Listen for changes on both pins
+        self.outputA.when_activated = self._update
+        self.outputA.when_deactivated = self._update
+        self.outputB.when_activated = self._update
+        self.outputB.when_deactivated = self._update
+
+    def _readState(self):
+        return (self.outputA.value << 1) | self.outputB.value
+
+    def _update(self):
+        state = self._readState()
+        step = self.QUADRATURE_STEPS[self.state*4 + state]
+        self.state = state
+        if not step:
+            return
+        self.position += step*self.polarity
+
+        # Only the nearest target has to be checked for every signal
+        if self.getPositionChange() >= self.next_target:
+            self._reachTargets()
+
+    def getSignalRate(self):
+        """
+        Estimates the speed in signals per second (negative going backwards), from how far the position has changed
+        since the speed was read about speed_window ago.
+
+        With thousands of signals per second, counting the signals over a fixed time is more precise than timing the
+        signals themselves - which also come in bursts, whenever the callbacks get to run.
+        """
+        now = time.perf_counter()
+        samples = self.samples
+        samples.append((now, self.position))
+        # Keep the newest sample that is at least a window old, or the oldest there is
+        while len(samples) > 2 and now - samples[1][0] >= self.speed_window:
+            samples.popleft()
+
+        then, then_position = samples[0]
+        elapsed = now - then
+        if elapsed <= 0:
+            return 0.0
+        return (self.position - then_position)/elapsed
+
+    def getSpeed(self):
+        # Speed in centimeters per second, in the tracked direction
+        return self.getSignalRate()*self.direction*self.signal_centimeter_ratio
+
+    def _reachTargets(self):
+        reached = []
+        with self.targets_lock:
+            while self.targets and self.getPositionChange() >= self.targets[0][0]:
+                reached.append(self.targets.pop(0)[1])
+            self.next_target = self.targets[0][0] if self.targets else math.inf
+        # Run the callbacks outside of the lock, so they can add or clear targets
+        for callback in reached:
+            callback()
+
+    def addTarget(self, signals, callback):
+        # Runs callback (from the encoder's thread) once the position has changed by this many signals
+        with self.targets_lock:
+            keys = [target[0] for target in self.targets]
+            self.targets.insert(bisect.bisect_right(keys, signals), [signals, callback])
+            self.next_target = self.targets[0][0]
+        # It might already be reached
+        self._reachTargets()
+
+    def clearTargets(self):
+        with self.targets_lock:
+            self.targets = []
+            self.next_target = math.inf
+
+    def distanceToSignals(self, centimeters):
+        return int(math.ceil(centimeters/self.signal_centimeter_ratio))
+
+    def startDistanceTracking(self, direction=1):
         self.old_position = self.position
+        self.direction = direction
+        # The speed from before does not say anything about the new move
+        self.samples.clear()
 
     def getPositionChange(self):
-        return self.position-self.old_position
+        # How far we have moved in the tracked direction
+        return (self.position-self.old_position)*self.direction
 
     def getDistance(self):
         position_change = self.getPositionChange()
@@ -148,63 +692,233 @@ class Encoder:
 
 
 class DCMotor:
-    def __init__(self, forward_pin, backward_pin, encoder_pins, pwm_pin, speed=1):
-        self.motor = Motor(forward_pin, backward_pin)
-        self.encoder = Encoder(encoder_pins)
+    def __init__(self, forward_pin, backward_pin, encoder_pins, pwm_pin, speed=0.9, max_speed=45, encoder_invert=False,
+                 pin_factory=None):
+        self.motor = Motor(forward_pin, backward_pin, pin_factory=pin_factory)
+        self.encoder = Encoder(encoder_pins, invert=encoder_invert, pin_factory=pin_factory)
         self.pid = PIDController(self.encoder, pwm_pin)
+        # Speed in centimeters per second at full power, used to guess the power needed for a speed
+        self.max_speed = max_speed
+        # Cruise speed as a fraction of max_speed - below 1, so the speed control can catch up a wheel
         self.speed = speed
-
-    def forward(self, distance):
-        self.encoder.startDistanceTracking()
-        self.motor.forward(self.speed)
-        thread = threading.Thread(target=self.wait_distance, args=(distance,))
-        thread.daemon = True
-        thread.start()
-
-    def backward(self, distance):
-        self.encoder.startDistanceTracking()
-        self.motor.backward(self.speed)
-        thread = threading.Thread(target=self.wait_distance, args=(distance,))
-        thread.daemon = True
-        thread.start()
-
-    def wait_distance(self, distance):
-        # while self.encoder.getPositionChange() <= self.encoder.signals_per_rotation:
-        #     sleep(0.001)
-        # We wait until the distance travelled equals what we asked for
-        while self.encoder.getDistance()["cm"] < distance:
-            sleep(0.001)
+        # Seconds to ramp up to the cruise speed and down again at the end of a move - 0 to start and stop at full
+        # speed - and the fractions of the cruise speed that moves start and end with
+        self.ramp_time = 0.15
+        self.start_speed = 0.3
+        self.end_speed = 0.15
+        # 1 forward, -1 backward and 0 stopped
+        self.direction = 0
+        # Speed in centimeters per second that the speed control holds, from the profile of the move if there is one
+        self.target_speed = 0
+        self.profile = None
+        self.move_distance = 0
+        # Makes sure that the control loop does not start the motor again right after it has been stopped
+        self.lock = threading.Lock()
+        # Future for the current move, done when the distance has been reached or the motor is stopped
+        self.move = None
+        self.loop = None
+        # Guard against a wheel that runs away or is stuck - the motor is stopped if it goes more than reverse_limit
+        # centimeters the wrong way, or does not get any further for stall_timeout seconds
+        self.reverse_limit = 2
+        self.stall_timeout = 1.0
+        self.progress_signals = 0
+        self.progress_time = 0
+        # Set when the guard has stopped the motor, so streamed velocities do not start it again until they stop - see
+        # Robot.setVelocity
+        self.failed = False
+
+    def forward(self, distance, speed=None):
+        return self.start(1, distance, speed)
+
+    def backward(self, distance, speed=None):
+        return self.start(-1, distance, speed)
+
+    def start(self, direction, distance, speed=None):
+        # Speed is a fraction of max_speed, the cruise speed if not given
+        if speed is None:
+            speed = self.speed
+        cruise_speed = speed*self.max_speed
+        if self.ramp_time:
+            # The acceleration scales with the cruise speed, so wheels going different speeds ramp at the same time
+            self.profile = MotionProfile(distance, cruise_speed, cruise_speed/self.ramp_time,
+                                         start_speed=cruise_speed*self.start_speed,
+                                         end_speed=cruise_speed*self.end_speed)
+            self.target_speed = self.profile.speedAt(0)
+        else:
+            self.profile = None
+            self.target_speed = cruise_speed
+
+        self.encoder.startDistanceTracking(direction)
+        self.resetProgress()
+        self.failed = False
+        self.move_distance = distance
+        self.pid.reset()
+        self.pid.setpoint = self.target_speed
+        self.direction = direction
+        self.setPower(self.target_speed/self.max_speed)
+        return self.stopAtDistance(distance)
+
+    def setVelocity(self, velocity):
+        # Drives without a distance at a signed speed in centimeters per second, until stopped or given a new velocity
+        direction = (velocity > 0) - (velocity < 0)
+        if not direction:
+            self.stop()
+            return
+
+        self.profile = None
+        self.target_speed = abs(velocity)
+        self.pid.setpoint = self.target_speed
+        if direction != self.direction:
+            self.encoder.clearTargets()
+            self.encoder.startDistanceTracking(direction)
+            self.resetProgress()
+            self.move_distance = 0
+            self.pid.reset()
+            self.direction = direction
+            # Start with the power we guess is needed, the speed control takes it from there
+            self.setPower(min(1.0, self.target_speed/self.max_speed))
+
+    def setPower(self, power):
+        with self.lock:
+            if self.direction > 0:
+                self.motor.forward(power)
+            elif self.direction < 0:
+                self.motor.backward(power)
+
+    def resetProgress(self):
+        self.progress_signals = 0
+        self.progress_time = time.perf_counter()
+
+    def checkProgress(self):
+        """
+        Stops the motor if the wheel goes the wrong way or has been stuck for too long. Otherwise the speed control
+        would see a speed that never comes up, and drive the power up to full - and a move whose distance is counted
+        the wrong way never ends.
+
+        :return: False if the motor has been stopped.
+        """
+        now = time.perf_counter()
+        change = self.encoder.getPositionChange()
+        if change > self.progress_signals:
+            self.progress_signals = change
+            self.progress_time = now
+            return True
+
+        if change < -self.encoder.distanceToSignals(self.reverse_limit):
+            self.fail("The encoder counts the wrong way - is encoder_invert set right for this motor?")
+            return False
+        if now - self.progress_time > self.stall_timeout:
+            self.fail("The wheel has not moved for " + str(self.stall_timeout) + " seconds")
+            return False
+        return True
+
+    def fail(self, message):
+        # Stops the motor, and fails the move that is waiting for it
+        logger.error(message)
+        self.failed = True
+        if self.move and not self.move.done():
+            self.move.set_exception(RuntimeError(message))
         self.stop()
 
+    def getProgress(self):
+        # How much of the current move has been done, from 0 to 1
+        if not self.move_distance:
+            return 1
+        return self.encoder.getDistance()["cm"]/self.move_distance
+
+    def stopAtDistance(self, distance):
+        # The encoder stops the motor itself when the distance is reached, and the returned future is then resolved
+        self.loop = asyncio.get_event_loop()
+        self.move = self.loop.create_future()
+        self.encoder.clearTargets()
+        self.encoder.addTarget(self.encoder.distanceToSignals(distance), self.stop)
+        return self.move
+
     def stop(self):
-        self.motor.stop()
+        with self.lock:
+            self.direction = 0
+            self.motor.stop()
+        self.encoder.clearTargets()
+
+        # Let whatever is waiting for the move know that it is done - this might be called from the encoder's thread
+        if self.move and not self.move.done():
+            self.loop.call_soon_threadsafe(self._resolveMove, self.move)
+
+    @staticmethod
+    def _resolveMove(move):
+        if not move.done():
+            move.set_result(True)
 
     def is_running(self):
         return self.motor.is_active
 
 
 class ServoMotor:
-    def __init__(self, servo_pin, min_pulse_width=0.4/1000, max_pulse_width=2.4/1000, frame_width=20/1000):
-        self.motor = Servo(servo_pin, min_pulse_width=min_pulse_width, max_pulse_width=max_pulse_width, frame_width=frame_width)
+    """
+    The front servo. A servo can't tell where it is, so where it is gets estimated from where it was told to go, when,
+    and how fast it moves (slew_rate, in degrees per second), with settle_time seconds extra for it to stop shaking.
+    """
+    def __init__(self, servo_pin, min_pulse_width=0.4/1000, max_pulse_width=2.4/1000, frame_width=20/1000,
+                 slew_rate=300, settle_time=0.05, pin_factory=None):
+        self.motor = Servo(servo_pin, min_pulse_width=min_pulse_width, max_pulse_width=max_pulse_width,
+                           frame_width=frame_width, pin_factory=pin_factory)
+        self.slew_rate = slew_rate
+        self.settle_time = settle_time
+
+        # The servo centers when it is created, from wherever it was - so it could have all the way to go
+        self.start_angle = 90.0
+        self.target_angle = 0.0
+        self.move_start = time.perf_counter()
+        self.settled_at = self.move_start + 90/self.slew_rate + self.settle_time
 
     def is_centered(self):
         return bool(self.motor.value == 0)
 
     def center(self):
-        self.motor.value = 0
+        self.setAngle(0)
 
     def turn(self, degrees):
         assert -90 <= degrees <= 90, "Degrees should be within -60 degrees and 60 degrees"
+        self.setAngle(degrees)
+
+    def setAngle(self, degrees):
+        if self.motor.value is not None and degrees == self.target_angle:
+            return
+        # It starts from wherever it has gotten to
+        now = time.perf_counter()
+        self.start_angle = self.getAngle(now)
+        self.target_angle = degrees
+        self.move_start = now
+        self.settled_at = now + abs(degrees - self.start_angle)/self.slew_rate + self.settle_time
         # Calculates value between -1 and +1 (min and max), for degrees given
         self.motor.value = degrees/90
 
+    def getAngle(self, now=None):
+        # Where the servo is estimated to be
+        if now is None:
+            now = time.perf_counter()
+        moved = (now - self.move_start)*self.slew_rate
+        distance = self.target_angle - self.start_angle
+        if moved >= abs(distance):
+            return self.target_angle
+        return self.start_angle + math.copysign(moved, distance)
+
     def stop(self):
+        # A detached servo stays about where it got to
+        now = time.perf_counter()
+        self.start_angle = self.target_angle = self.getAngle(now)
+        self.settled_at = now
         self.motor.detach()
 
     def is_running(self):
-        # TODO: can we check if servo is running?
-        # return self.motor.is_active
-        return False
+        return time.perf_counter() < self.settled_at
+
+    async def settled(self):
+        # Waits until the servo has reached where it was last told to go - also if it is told somewhere else meanwhile
+        remaining = self.settled_at - time.perf_counter()
+        while remaining > 0:
+            await asyncio.sleep(remaining)
+            remaining = self.settled_at - time.perf_counter()
 
 
 # # Shared functions
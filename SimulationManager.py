@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+import RobotManager
+
+logger = logging.getLogger("SimulationManager")
+
+# States of the encoder pins (A, B) in the order they come when driving forwards
+QUADRATURE_SEQUENCE = [(0, 0), (1, 0), (1, 1), (0, 1)]
+
+
+def createPinFactory():
+    # Mock pins that the simulators can drive, with PWM for the motors and servo.
+    # Also made the default, since gpiozero 1.5 does not pass pin_factory on to the pins inside a Motor
+    pin_factory = MockFactory(pin_class=MockPWMPin)
+    Device.pin_factory = pin_factory
+    return pin_factory
+
+
+class MotorSimulator:
+    """
+    Simulates a DC motor with a quadrature encoder.
+
+    The wheel speed follows the motor power with a first order lag, and the encoder pins are toggled for every
+    signal the wheel would give at that speed.
+    """
+    def __init__(self, dc_motor: RobotManager.DCMotor, max_speed=45, time_constant=0.05, efficiency=1.0):
+        self.dc_motor = dc_motor
+        self.pin_a = dc_motor.encoder.outputA.pin
+        self.pin_b = dc_motor.encoder.outputB.pin
+        # Speed in centimeters per second at full power, and how much of it this motor actually gets
+        self.max_speed = max_speed
+        self.efficiency = efficiency
+        # Seconds for the speed to get most of the way to a new power
+        self.time_constant = time_constant
+
+        self.speed = 0.0
+        self.signals = 0.0
+        self.phase = QUADRATURE_SEQUENCE.index((int(self.pin_a.state), int(self.pin_b.state)))
+
+    def step(self, dt):
+        power = self.dc_motor.motor.value or 0
+        target = power*self.max_speed*self.efficiency
+        self.speed += (target - self.speed)*min(1.0, dt/self.time_constant)
+
+        self.signals += self.speed*dt/self.dc_motor.encoder.signal_centimeter_ratio
+        while abs(self.signals) >= 1:
+            step = 1 if self.signals > 0 else -1
+            self.signals -= step
+            self.phase = (self.phase + step) % len(QUADRATURE_SEQUENCE)
+            a, b = QUADRATURE_SEQUENCE[self.phase]
+            # Only one of the pins changes per signal
+            self.setPin(self.pin_a, a)
+            self.setPin(self.pin_b, b)
+
+    @staticmethod
+    def setPin(pin, state):
+        if bool(pin.state) == bool(state):
+            return
+        if state:
+            pin.drive_high()
+        else:
+            pin.drive_low()
+
+
+class ServoSimulator:
+    """
+    Simulates the front servo moving towards its set position at a limited speed.
+    """
+    def __init__(self, servo_motor: RobotManager.ServoMotor, slew_rate=300):
+        self.servo_motor = servo_motor
+        # Degrees per second
+        self.slew_rate = slew_rate
+        self.angle = 0.0
+
+    def getTarget(self):
+        value = self.servo_motor.motor.value
+        # A detached servo stays where it is
+        if value is None:
+            return self.angle
+        return value*90
+
+    def step(self, dt):
+        target = self.getTarget()
+        max_move = self.slew_rate*dt
+        self.angle += min(max(target - self.angle, -max_move), max_move)
+
+    def is_settled(self):
+        return abs(self.getTarget() - self.angle) < 0.5
+
+
+class Simulation:
+    """
+    Runs simulators for all the hardware of a robot, which has to be made with the pin factory from
+    :func:`createPinFactory`, on a background thread.
+    """
+    def __init__(self, robot: RobotManager.Robot, motor_speed=45, servo_slew_rate=300, right_efficiency=1.0,
+                 rate=1000):
+        self.robot = robot
+        self.left = MotorSimulator(robot.leftDC, max_speed=motor_speed)
+        self.right = MotorSimulator(robot.rightDC, max_speed=motor_speed, efficiency=right_efficiency)
+        self.servo = ServoSimulator(robot.frontServo, slew_rate=servo_slew_rate)
+        # The robot's timing model of the servo should match the servo it drives, like it would be set up for a real one
+        robot.frontServo.slew_rate = servo_slew_rate
+        self.period = 1/rate
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        logger.info("Starting simulation")
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        last = time.perf_counter()
+        while self.running:
+            time.sleep(self.period)
+            now = time.perf_counter()
+            dt = now - last
+            last = now
+            self.left.step(dt)
+            self.right.step(dt)
+            self.servo.step(dt)
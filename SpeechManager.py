@@ -4,38 +4,540 @@ import collections
 from concurrent.futures import ThreadPoolExecutor
 import logging
 import math
+import multiprocessing
+from multiprocessing import shared_memory
 import threading
+import time
+from numpy.lib.stride_tricks import sliding_window_view
 import av
-import librosa
 import numpy as np
 import pyaudio
+import torch
 from aiortc.mediastreams import MediaStreamError
 from danspeech import Recognizer
 from danspeech.errors.recognizer_errors import NoDataInBuffer, WaitTimeoutError, WrongUsageOfListen
 from danspeech.pretrained_models import TransferLearned
-from danspeech.audio.resources import Microphone, SpeechSource, AudioData
+from danspeech.audio.resources import SpeechSource, AudioData
 from danspeech.language_models import DSL3gram
 from pymitter import EventEmitter
 
 logger = logging.getLogger("SpeechManager")
 # np.set_printoptions(threshold=numpy.inf)
-p = pyaudio.PyAudio()
+
+
+class RingBuffer:
+    """
+    Preallocated int16 ring buffer used between the WebRTC track and the audio consumer.
+
+    Writing and reading only copies the samples involved, so the cost is O(frame) no matter how much audio is
+    waiting in the buffer. If the writer gets too far ahead, the oldest samples are overwritten and counted as an
+    overrun, and reading more than is available is counted as an underrun.
+    """
+    def __init__(self, capacity, dtype=np.int16):
+        self.capacity = int(capacity)
+        self.data = np.zeros(self.capacity, dtype=dtype)
+        self.read_pos = 0
+        self.size = 0
+        self.overruns = 0
+        self.underruns = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return self.size
+
+    def write(self, samples: np.ndarray):
+        samples = np.asarray(samples, dtype=self.data.dtype)
+        count = len(samples)
+        if count == 0:
+            return
+
+        with self.condition:
+            # If the frame is bigger than the whole buffer, only the newest samples can be kept
+            if count > self.capacity:
+                self.overruns += 1
+                samples = samples[-self.capacity:]
+                count = self.capacity
+
+            # Drop the oldest samples if there is not enough free space
+            free = self.capacity - self.size
+            if count > free:
+                self.overruns += 1
+                dropped = count - free
+                self.read_pos = (self.read_pos + dropped) % self.capacity
+                self.size -= dropped
+
+            write_pos = (self.read_pos + self.size) % self.capacity
+            first = min(count, self.capacity - write_pos)
+            self.data[write_pos:write_pos + first] = samples[:first]
+            if first < count:
+                self.data[:count - first] = samples[first:]
+            self.size += count
+            self.condition.notify_all()
+
+    def read(self, count, out: np.ndarray = None, timeout=0):
+        """
+        Reads exactly count samples into out (or a new array).
+
+        If timeout is given, waits up to that many seconds (None waits forever) for enough samples to arrive.
+        Returns None if not enough samples are available, or if the buffer has been closed.
+        """
+        with self.condition:
+            if self.size < count and timeout != 0:
+                self.condition.wait_for(lambda: self.size >= count or self.closed, timeout=timeout)
+
+            if self.size < count:
+                self.underruns += 1
+                return None
+
+            if out is None:
+                out = np.empty(count, dtype=self.data.dtype)
+
+            first = min(count, self.capacity - self.read_pos)
+            out[:first] = self.data[self.read_pos:self.read_pos + first]
+            if first < count:
+                out[first:count] = self.data[:count - first]
+            self.read_pos = (self.read_pos + count) % self.capacity
+            self.size -= count
+        return out
+
+    def clear(self):
+        with self.condition:
+            self.read_pos = 0
+            self.size = 0
+
+    def close(self):
+        # Wakes up any waiting readers, which will then get None
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class SharedRingBuffer:
+    """
+    int16 ring buffer in shared memory, for passing audio to another process without pickling it through a pipe.
+
+    Has the same write, read and close methods as :class:`RingBuffer`, for one writing and one reading process. The
+    header holds the total number of samples written and read. Nothing orders the plain stores to shared memory
+    between processes - on ARM the count can be seen before the samples - so the header and samples are only touched
+    while holding a multiprocessing lock, which both processes get when the reading one is started. It is only held
+    while copying one frame, and if the other process dies holding it, a write is dropped or a read comes back
+    empty after lock_timeout instead of blocking forever. The reader can not be woken up across processes, so
+    reading with a timeout polls.
+    """
+    # int64 header fields
+    WRITTEN, READ, ENDED, CAPACITY = range(4)
+    HEADER_BYTES = 4*8
+
+    def __init__(self, lock, capacity=None, name=None, poll_interval=0.005, lock_timeout=0.1):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER_BYTES + int(capacity)*2)
+            self.owner = True
+        else:
+            # Attached by a process started from the owner, which shares its resource tracker - so it is still only
+            # unlinked once, by the owner
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.header = np.ndarray((4,), dtype=np.int64, buffer=self.shm.buf)
+        if self.owner:
+            self.header[:] = 0
+            self.header[self.CAPACITY] = int(capacity)
+        # The size of the memory can be rounded up to whole pages, so the capacity comes from the header
+        self.capacity = int(self.header[self.CAPACITY])
+        self.data = np.ndarray((self.capacity,), dtype=np.int16, buffer=self.shm.buf, offset=self.HEADER_BYTES)
+        self.lock = lock
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        # Counted by the process that sees them - overruns by the writer, underruns by the reader
+        self.overruns = 0
+        self.underruns = 0
+
+    def __len__(self):
+        return int(min(self.header[self.WRITTEN] - self.header[self.READ], self.capacity))
+
+    @property
+    def closed(self):
+        return bool(self.header[self.ENDED])
+
+    def write(self, samples: np.ndarray):
+        samples = np.asarray(samples, dtype=np.int16)
+        count = len(samples)
+        # The stream can be closed and released before the track it comes from has stopped
+        if count == 0 or self.header is None:
+            return
+
+        if not self.lock.acquire(timeout=self.lock_timeout):
+            self.overruns += 1
+            return
+        try:
+            self.writeLocked(samples, count)
+        finally:
+            self.lock.release()
+
+    def writeLocked(self, samples, count):
+        written = int(self.header[self.WRITTEN])
+        # Writing again after close means a new stream has started
+        self.header[self.ENDED] = 0
+        if written + count - self.header[self.READ] > self.capacity:
+            # The reader skips the samples that have been overwritten
+            self.overruns += 1
+        if count > self.capacity:
+            written += count - self.capacity
+            samples = samples[-self.capacity:]
+            count = self.capacity
+
+        write_pos = written % self.capacity
+        first = min(count, self.capacity - write_pos)
+        self.data[write_pos:write_pos + first] = samples[:first]
+        if first < count:
+            self.data[:count - first] = samples[first:]
+        self.header[self.WRITTEN] = written + count
+
+    def read(self, count, out: np.ndarray = None, timeout=0):
+        """
+        Reads exactly count samples into out (or a new array), like :meth:`RingBuffer.read`.
+
+        Returns None if not enough samples arrive within the timeout, or if the writer has closed the buffer.
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            if not self.lock.acquire(timeout=self.lock_timeout):
+                self.underruns += 1
+                return None
+            try:
+                closed = self.closed
+                available = int(self.header[self.WRITTEN] - self.header[self.READ])
+                if available >= count:
+                    return self.readLocked(count, available, out)
+            finally:
+                self.lock.release()
+
+            if closed or (deadline is not None and time.perf_counter() >= deadline):
+                self.underruns += 1
+                return None
+            time.sleep(self.poll_interval)
+
+    def readLocked(self, count, available, out):
+        read = int(self.header[self.READ])
+        if available > self.capacity:
+            # The writer has lapped the reader, so continue from the oldest samples that are still there
+            read += available - self.capacity
+
+        if out is None:
+            out = np.empty(count, dtype=np.int16)
+        read_pos = read % self.capacity
+        first = min(count, self.capacity - read_pos)
+        out[:first] = self.data[read_pos:read_pos + first]
+        if first < count:
+            out[first:count] = self.data[:count - first]
+        self.header[self.READ] = read + count
+        return out
+
+    def clear(self):
+        with self.lock:
+            self.header[self.READ] = self.header[self.WRITTEN]
+
+    def close(self):
+        # Tells the reader that the stream has ended - the buffer itself stays usable until it is released
+        if self.header is not None and self.lock.acquire(timeout=self.lock_timeout):
+            try:
+                self.header[self.ENDED] = 1
+            finally:
+                self.lock.release()
+
+    def release(self):
+        # The arrays have to go before the memory can be closed
+        self.header = None
+        self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class Resampler:
+    """
+    Streaming polyphase resampler, which downmixes and resamples audio frames in one vectorized pass.
+
+    The low-pass filter taps are designed once, split into one kernel per phase, and reused for every frame. The
+    last samples of each frame are kept as history, so the filter runs continuously across frame boundaries.
+    """
+    def __init__(self, in_rate, out_rate, channels=1, zero_crossings=8):
+        g = math.gcd(in_rate, out_rate)
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.channels = channels
+
+        # Windowed sinc low-pass, designed at the upsampled rate with the cutoff at the lowest nyquist frequency
+        factor = max(self.up, self.down)
+        num_taps = 2*zero_crossings*factor + 1
+        t = np.arange(num_taps) - (num_taps - 1)/2
+        taps = np.sinc(t/factor) * np.kaiser(num_taps, 8.0)
+        taps *= self.up/taps.sum()
+
+        # Split the taps into phases - phase p uses taps p, p+up, p+2*up, ...
+        self.taps_per_phase = int(math.ceil(num_taps/self.up))
+        padded = np.zeros(self.taps_per_phase*self.up)
+        padded[:num_taps] = taps
+        # Reversed, so a kernel can be multiplied directly with a window of input samples in time order
+        self.kernels = padded.reshape(self.taps_per_phase, self.up).T[:, ::-1].astype(np.float32)
+
+        # The samples needed from the previous frame, and the position of the next output in upsampled samples
+        self.history = np.zeros(self.taps_per_phase - 1, dtype=np.float32)
+        self.position = (self.taps_per_phase - 1)*self.up
+        self.work = np.zeros(0, dtype=np.float32)
+        self.index_cache = {}
+
+    def getIndices(self, length):
+        # The frames are usually the same size every time, so the output positions repeat and can be cached
+        key = (self.position, length)
+        if key not in self.index_cache:
+            positions = np.arange(self.position, length*self.up, self.down)
+            self.index_cache[key] = (positions//self.up - (self.taps_per_phase - 1), positions % self.up,
+                                     positions[-1] + self.down if len(positions) else self.position)
+        return self.index_cache[key]
+
+    def process(self, samples: np.ndarray):
+        """
+        Takes interleaved int16 samples and returns mono int16 samples at the output rate.
+        """
+        history_len = len(self.history)
+        frame_len = len(samples)//self.channels
+        length = history_len + frame_len
+        if len(self.work) < length:
+            self.work = np.zeros(length, dtype=np.float32)
+        buf = self.work[:length]
+        buf[:history_len] = self.history
+
+        # Downmix into the work buffer after the history
+        if self.channels > 1:
+            np.mean(samples[:frame_len*self.channels].reshape(frame_len, self.channels), axis=1, out=buf[history_len:])
+        else:
+            buf[history_len:] = samples[:frame_len]
+
+        starts, phases, next_position = self.getIndices(length)
+        windows = sliding_window_view(buf, self.taps_per_phase)
+        out = np.einsum("ij,ij->i", windows[starts], self.kernels[phases])
+
+        # Keep the tail for the next frame, and move the output position to be relative to it
+        self.history[:] = buf[length - history_len:]
+        self.position = next_position - (length - history_len)*self.up
+
+        return np.clip(out, -32768, 32767).astype(np.int16)
+
+
+class AudioAccumulator:
+    """
+    Growable audio buffer for collecting an utterance.
+
+    The capacity doubles when it runs out, so appending is amortised O(chunk) instead of copying the whole utterance
+    every time, and resetting keeps the memory for the next utterance. :meth:`view` returns a view into the buffer,
+    which is only valid until the next reset.
+    """
+    def __init__(self, capacity=16000, dtype=None):
+        self.initial_capacity = capacity
+        self.data = np.empty(capacity, dtype=dtype) if dtype else None
+        self.size = 0
+
+        # Instrumentation for the current utterance
+        self.allocations = 0
+        self.append_time = 0.0
+        self.peak_capacity = capacity
+
+    def __len__(self):
+        return self.size
+
+    def append(self, samples):
+        start = time.perf_counter()
+        samples = np.asarray(samples)
+        # The first chunk decides the dtype
+        if self.data is None:
+            self.data = np.empty(self.initial_capacity, dtype=samples.dtype)
+            self.allocations += 1
+
+        needed = self.size + len(samples)
+        if needed > len(self.data):
+            capacity = len(self.data)
+            while capacity < needed:
+                capacity *= 2
+            data = np.empty(capacity, dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+            self.allocations += 1
+            self.peak_capacity = max(self.peak_capacity, capacity)
+
+        self.data[self.size:needed] = samples
+        self.size = needed
+        self.append_time += time.perf_counter() - start
+
+    def view(self):
+        if self.data is None:
+            return np.empty(0)
+        return self.data[:self.size]
+
+    def stats(self):
+        return {"samples": self.size, "allocations": self.allocations, "capacity": self.peak_capacity,
+                "append_ms": self.append_time*1000}
+
+    def reset(self):
+        if self.size:
+            logger.debug("Utterance accumulator: " + str(self.stats()))
+        self.size = 0
+        self.allocations = 0
+        self.append_time = 0.0
+
+
+class VoiceActivityDetector:
+    """
+    Voice activity detection based on frame energy and zero-crossing rate, with a hangover so short pauses inside
+    a phrase do not end it.
+
+    Samples are split into short frames, and the energy and zero-crossing rate of all the frames in a chunk are
+    computed in one go with numpy. Only frames that are part of speech are kept, and :meth:`process` returns the
+    finished speech segments, so the model only runs when someone has actually said something.
+    """
+    def __init__(self, sampling_rate=16000, frame_ms=20, energy_threshold=300, dynamic_energy_threshold=True,
+                 dynamic_energy_ratio=1.5, min_zcr=0.01, max_zcr=0.4, start_ms=60, hangover_ms=600, pre_roll_ms=300,
+                 min_speech_ms=250, max_speech_ms=10000):
+        self.sampling_rate = sampling_rate
+        self.frame_len = int(sampling_rate*frame_ms/1000)
+        # Minimum RMS energy (same unit as audioop.rms on int16 audio) for a frame to count as speech
+        self.energy_threshold = energy_threshold
+        # If enabled, the threshold follows the noise floor while nobody is speaking
+        self.dynamic_energy_threshold = dynamic_energy_threshold
+        self.dynamic_energy_ratio = dynamic_energy_ratio
+        self.min_energy_threshold = energy_threshold
+        self.noise_damping = 0.95
+        # Speech has a zero-crossing rate in between hum (too low) and hiss (too high)
+        self.min_zcr = min_zcr
+        self.max_zcr = max_zcr
+        # Durations in frames
+        self.start_frames = max(1, int(start_ms/frame_ms))
+        self.hangover_frames = int(hangover_ms/frame_ms)
+        self.pre_roll_frames = int(pre_roll_ms/frame_ms)
+        self.min_speech_frames = int(min_speech_ms/frame_ms)
+        self.max_speech_frames = int(max_speech_ms/frame_ms)
+
+        # Samples left over that did not fill a whole frame
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.pre_roll = collections.deque(maxlen=self.pre_roll_frames + self.start_frames)
+        self.segment = AudioAccumulator(sampling_rate*2, dtype=np.int16)
+        self.in_speech = False
+        self.speech_count = 0
+        self.silence_count = 0
+        self.segment_speech = 0
+
+        # Statistics
+        self.total_frames = 0
+        self.speech_frames = 0
+        self.segments = 0
+
+    def frameFeatures(self, frames: np.ndarray):
+        # RMS energy and zero-crossing rate for every row of frames
+        floats = frames.astype(np.float32)
+        energy = np.sqrt(np.mean(floats*floats, axis=1))
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1)/(self.frame_len - 1)
+        return energy, zcr
+
+    def process(self, samples: np.ndarray):
+        """
+        Feeds int16 samples to the detector, and returns a list of the speech segments that ended within them.
+        """
+        if len(self.remainder):
+            samples = np.concatenate((self.remainder, samples))
+        num_frames = len(samples)//self.frame_len
+        self.remainder = samples[num_frames*self.frame_len:].copy()
+        if num_frames == 0:
+            return []
+
+        frames = samples[:num_frames*self.frame_len].reshape(num_frames, self.frame_len)
+        energy, zcr = self.frameFeatures(frames)
+        voiced = (zcr >= self.min_zcr) & (zcr <= self.max_zcr)
+
+        segments = []
+        for i in range(num_frames):
+            self.total_frames += 1
+            is_speech = bool(voiced[i] and energy[i] > self.energy_threshold)
+
+            if not self.in_speech:
+                self.pre_roll.append(frames[i])
+                self.speech_count = self.speech_count + 1 if is_speech else 0
+
+                # Dynamically adjust the threshold to the noise floor, like the danspeech Recognizer does
+                if self.dynamic_energy_threshold and not is_speech:
+                    target = energy[i]*self.dynamic_energy_ratio
+                    self.energy_threshold = max(self.min_energy_threshold,
+                                                self.energy_threshold*self.noise_damping +
+                                                target*(1 - self.noise_damping))
+
+                # Enough speech in a row to start a segment - include the frames from before it started
+                if self.speech_count >= self.start_frames:
+                    self.in_speech = True
+                    for frame in self.pre_roll:
+                        self.segment.append(frame)
+                    self.pre_roll.clear()
+                    self.silence_count = 0
+                    self.segment_speech = self.speech_count
+            else:
+                self.segment.append(frames[i])
+                if is_speech:
+                    self.silence_count = 0
+                    self.segment_speech += 1
+                else:
+                    self.silence_count += 1
+
+                too_long = len(self.segment) >= self.max_speech_frames*self.frame_len
+                if self.silence_count > self.hangover_frames or too_long:
+                    segment = self.endSegment()
+                    if segment is not None:
+                        segments.append(segment)
+        return segments
+
+    def endSegment(self):
+        # Discard segments with too little speech in them, like a door slamming
+        speech_len = self.segment_speech
+        self.in_speech = False
+        self.speech_count = 0
+        self.silence_count = 0
+        self.segment_speech = 0
+
+        if speech_len < self.min_speech_frames:
+            self.segment.reset()
+            return None
+        self.speech_frames += len(self.segment)//self.frame_len
+        self.segments += 1
+        # Copy it out, since the accumulator is reused for the next segment
+        segment = self.segment.view().copy()
+        self.segment.reset()
+        return segment
+
+    def reset(self):
+        self.remainder = np.zeros(0, dtype=np.int16)
+        self.pre_roll.clear()
+        self.segment.reset()
+        self.in_speech = False
+        self.speech_count = 0
+        self.silence_count = 0
+        self.segment_speech = 0
 
 
 class TrackStream:
-    def __init__(self, track):
+    def __init__(self, track, buffer=None):
         self.track = track
-        self.samp_rate = 48000
-        self.channels = 2
-        self.chunk_size = int(512*2)
-        # self.chunk_size = 1280
-        # self.chunk_size = 960
-        self.format = pyaudio.paInt16
-        self.stream = None
+        # The format DanSpeech wants - 16 kHz mono
+        self.samp_rate = 16000
+        self.channels = 1
         self.thread_loop = None
-        self.use_blocking = True
+        self.initialized = False
+        self.resampler = None
         self.loop = asyncio.get_event_loop()
-        self.buffer = []
+        # Room for 2 seconds of audio, more than that means the consumer has fallen behind. Can also be a
+        # SharedRingBuffer, to send the audio to a RecognitionWorker
+        self.buffer = buffer if buffer is not None else RingBuffer(self.samp_rate*self.channels*2)
+        self.ended = False
         self.executor = ThreadPoolExecutor(max_workers=3)
 
     def startWriting(self):
@@ -60,9 +562,9 @@ class TrackStream:
 
             if type(frame) is not av.audio.frame.AudioFrame:
                 logger.error("Not audio frame")
-                return
+                return True
 
-            if not self.stream:
+            if not self.initialized:
                 logger.debug("Audio stream frame information:")
                 logger.debug("--------------------")
                 logger.debug("Frame: " + str(frame))
@@ -73,110 +575,89 @@ class TrackStream:
                 logger.debug("Bits: " + str(frame.format.bits))
                 logger.debug("Sample rate: " + str(frame.sample_rate))
                 logger.debug("Samples: " + str(frame.samples))
-                logger.debug("Original array size: " + str(len(frame.to_ndarray().reshape(1920, ))))
-                logger.debug("--------------------")
-                # if frame.sample_rate:
-                #     self.samp_rate = frame.sample_rate
-                # self.channels = len(frame.layout.channels)
-
-                self.stream = p.open(rate=self.samp_rate*self.channels, format=self.format, channels=self.channels,
-                                     output=True, input=True, frames_per_buffer=int(self.chunk_size*self.channels))
-
-                logger.debug("Stream information:")
-                logger.debug("--------------------")
-                logger.debug("Format: " + str(int(self.format*2)))
-                logger.debug("Channels: " + str(self.channels))
-                logger.debug("Sample rate: " + str(self.samp_rate*self.channels) + " ("+str(self.samp_rate)+")")
-                logger.debug("Cache size: " + str(int(self.chunk_size*self.channels)))
+                logger.debug("Original array size: " + str(frame.to_ndarray().size))
                 logger.debug("--------------------")
+                logger.debug("Output: " + str(self.channels) + " channel(s) at " + str(self.samp_rate) + " Hz")
+                self.initialized = True
 
             # self.writeToBuffer(frame)
             await self.loop.run_in_executor(self.executor, self.writeToBuffer, frame)
+            return True
         except MediaStreamError as e:
             logger.error(str(e))
-            return
+            return False
         except Exception as e:
             logger.error(str(e))
-            return
+            return False
 
     def writeToBuffer(self, frame):
         # logger.info("got frame")
-        frame_arr: np.ndarray = frame.to_ndarray().reshape(1920, )
-
-        # Transform frame if needed
-        re_sampled = None
-        if frame.sample_rate != self.samp_rate:
-            frame_float = frame_arr.astype(dtype='float32')
-            re_sampled = librosa.resample(frame_float, frame.sample_rate, self.samp_rate, res_type='zero_order_hold')
-
-        if (len(frame.layout.channels) == 2) and (self.channels == 1):
-            if re_sampled is not None:
-                re_sampled = re_sampled[::2]
-                frame_arr = re_sampled.astype(dtype='int16')
-            else:
-                frame_arr = frame_arr[::2]
-        else:
-            if re_sampled is not None:
-                frame_arr = re_sampled.astype(dtype='int16')
+        frame_arr: np.ndarray = frame.to_ndarray()
+        channels = len(frame.layout.channels)
+        if frame.format.is_planar:
+            # One row per channel, interleave them
+            frame_arr = frame_arr.T
+        frame_arr = frame_arr.reshape(-1)
 
-        # Add to buffer
-        self.buffer = self.buffer + frame_arr.tolist()
+        # Make a new resampler if the frames change format
+        if not self.resampler or self.resampler.in_rate != frame.sample_rate or self.resampler.channels != channels:
+            self.resampler = Resampler(frame.sample_rate, self.samp_rate, channels=channels)
 
-        # logger.debug("Frame " + str(i) + ":")
-        # logger.debug("--------------------")
-        # logger.debug("Time: " + str(frame.time))
-        # logger.debug("Array: " + str(frame_arr))
-        # # logger.debug(frame_arr.tobytes())
-        # # logger.debug(len(frame_arr))
-        # logger.debug("Current buffer size: " + str(len(self.buffer)))
-        # logger.debug("--------------------")
+        # Add to buffer
+        self.buffer.write(self.resampler.process(frame_arr))
 
     async def writeToStream(self):
         logger.info("Running audio track frames...")
 
-        i = 0
         while True:
-            i += 1
             await asyncio.sleep(0)
-            # await asyncio.sleep(0.02)
-            try:
-                # Get a new frame and add it to the buffer
-                await self.getFrame()
-
-                # Write frames from the buffer
-                if self.use_blocking:
-                    to_write = self.chunk_size*self.channels
-                    if len(self.buffer) > to_write:
-                        # print("More than buffer size")
-                        toWrite = np.array(self.buffer[:to_write])
-                        self.buffer = self.buffer[to_write:]
-                        self.loop.run_in_executor(self.executor, self.stream.write, toWrite.tobytes())
-            except Exception as e:
-                logger.error(str(e))
-                return
+            # Get a new frame and add it to the buffer
+            if not await self.getFrame():
+                break
 
+        # The track has ended, so let the readers know that no more audio is coming
+        logger.debug("Buffer overruns: " + str(self.buffer.overruns) +
+                     " - underruns: " + str(self.buffer.underruns))
+        self.buffer.close()
+        self.ended = True
 
-class MicInput(Microphone):
-    def __init__(self, sampling_rate=16000, chunk_size=1024, pyaudio_stream=None):
-        super().__init__(sampling_rate=sampling_rate, chunk_size=chunk_size)
-        self.pyaudio_stream = pyaudio_stream
+
+class TrackSource(SpeechSource):
+    """
+    Speech source which reads the audio of a TrackStream straight from its buffer, so the frames from the WebRTC
+    track go to DanSpeech without going through a PyAudio device.
+
+    Can be used everywhere a :class:`Microphone` can.
+    """
+    def __init__(self, track_stream: TrackStream, chunk_size=1024):
+        self.track_stream = track_stream
+        self.format = pyaudio.paInt16
+        self.sampling_width = 2
+        self.sampling_rate = track_stream.samp_rate
+        self.chunk = chunk_size
+        self.stream = None
 
     def __enter__(self):
         assert self.stream is None, "This audio source is already inside a context manager"
-        self.audio = self.pyaudio_module.PyAudio()
-        try:
-            self.stream = Microphone.MicrophoneStream(self.pyaudio_stream)
-        except Exception:
-            self.audio.terminate()
+        self.stream = TrackSource.TrackSourceStream(self.track_stream.buffer)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        print("STOPPING STREAM!")
-        # try:
-        #     self.stream.close()
-        # finally:
         self.stream = None
-        self.audio.terminate()
+
+    class TrackSourceStream:
+        def __init__(self, buffer: RingBuffer):
+            self.buffer = buffer
+
+        def read(self, size):
+            # Blocks until there is enough audio, like a PyAudio stream. Empty bytes means the track has ended.
+            samples = self.buffer.read(size, timeout=None)
+            if samples is None:
+                return b""
+            return samples.tobytes()
+
+        def close(self):
+            pass
 
 
 class CustomRecognizer(Recognizer):
@@ -335,8 +816,7 @@ class CustomRecognizer(Recognizer):
         self.stream_thread_stopper = stopper
 
         is_last = False
-        is_first_data = False
-        data_array = []
+        data_array = AudioAccumulator()
 
         while self.stream:
             # Loop for data (gets all the available data from the stream)
@@ -345,19 +825,13 @@ class CustomRecognizer(Recognizer):
                 await asyncio.sleep(0)
                 # If it is the last one in a stream, break and perform recognition no matter what
                 if is_last:
-                    is_first_data = True
                     break
 
                 # Get all available data
                 try:
-                    if is_first_data:
-                        print("streaming - 4")
-                        is_last, data_array = await data_getter()
-                        is_first_data = False
-                    else:
-                        print("streaming - 5")
-                        is_last, temp = await data_getter()
-                        data_array = np.concatenate((data_array, temp))
+                    print("streaming - 5")
+                    is_last, temp = await data_getter()
+                    data_array.append(temp)
                 # If this exception is thrown, then we no available data
                 except NoDataInBuffer:
                     # If no data in buffer, we sleep and wait
@@ -367,10 +841,10 @@ class CustomRecognizer(Recognizer):
             # We only do a prediction if the length of gathered audio is above a threshold
             print("streaming - 6")
             if len(data_array) > self.mininum_required_speaking_seconds * source.sampling_rate:
-                yield self.recognize(data_array)
+                yield self.recognize(data_array.view())
 
             is_last = False
-            data_array = []
+            data_array.reset()
             print("streaming - 7")
 
     async def real_time_streaming(self, source):
@@ -426,7 +900,7 @@ class CustomRecognizer(Recognizer):
         # First pass, we need more samples due to padding of initial conv layers
         first_sample_requirement = general_sample_requirement + (samples_pr_10ms * 15)
 
-        data_array = []
+        data_array = AudioAccumulator()
         is_first_data = True
         is_first_pass = True
         stopper, data_getter = await self.listen_in_background(source)
@@ -448,14 +922,10 @@ class CustomRecognizer(Recognizer):
 
                 # Get all available data
                 try:
-                    if is_first_data:
-                        is_last, data_array = await data_getter()
-                        is_first_data = False
-                        data_success = True
-                    else:
-                        is_last, temp = await data_getter()
-                        data_array = np.concatenate((data_array, temp))
-                        data_success = True
+                    is_last, temp = await data_getter()
+                    data_array.append(temp)
+                    is_first_data = False
+                    data_success = True
                 # If this exception is thrown, then we have no available data
                 except NoDataInBuffer:
                     # If it is first data and no data in buffer, then do not break but sleep.
@@ -486,34 +956,34 @@ class CustomRecognizer(Recognizer):
 
                 # Check if we have enough frames for first pass
                 elif len(data_array) >= first_sample_requirement:
-                    output = self.danspeech_recognizer.streaming_transcribe(data_array,
+                    output = self.danspeech_recognizer.streaming_transcribe(data_array.view(),
                                                                             is_last=False,
                                                                             is_first=True)
                     # Now first pass has been performed
                     is_first_pass = False
 
                     # Gather new data buffer
-                    data_array = []
+                    data_array.reset()
                     is_first_data = True
             else:
 
                 # If is last, we do not care about general sample requirement but just pass it through
                 if is_last:
-                    output = self.danspeech_recognizer.streaming_transcribe(data_array,
+                    output = self.danspeech_recognizer.streaming_transcribe(data_array.view(),
                                                                             is_last=is_last,
                                                                             is_first=False)
                     # Gather new data buffer
-                    data_array = []
+                    data_array.reset()
                     is_first_data = True
 
                 # General case! We need some data.
                 elif len(data_array) >= general_sample_requirement:
-                    output = self.danspeech_recognizer.streaming_transcribe(data_array,
+                    output = self.danspeech_recognizer.streaming_transcribe(data_array.view(),
                                                                             is_last=is_last,
                                                                             is_first=False)
 
                     # Gather new data buffer
-                    data_array = []
+                    data_array.reset()
                     is_first_data = True
 
             # Is last should always generate output!
@@ -735,13 +1205,13 @@ class CustomRecognizer(Recognizer):
                                  "since this instance has completed a full listen.")
 
 
-class DanSpeecher():
-    def __init__(self, mic: Microphone):
-        # Variables
-        self.transcribing = False
-
-        # Init a microphone object
-        self.m = mic
+class SpeechModels:
+    """
+    The DanSpeech model and language model with a Recognizer for them. Loading them takes many seconds, so they are
+    loaded once and shared by every DanSpeecher.
+    """
+    def __init__(self, warm_up=True, max_batch=8):
+        start = time.perf_counter()
 
         # Init a DanSpeech model and create a Recognizer instance
         self.model = TransferLearned()
@@ -749,14 +1219,324 @@ class DanSpeecher():
         # self.recognizer = CustomRecognizer(model=self.model)
 
         # Try using the DSL 3 gram language model
+        self.lm = None
         try:
             self.lm = DSL3gram()
             self.recognizer.update_decoder(lm=self.lm)
         except ImportError:
             logger.info("ctcdecode not installed. Using greedy decoding.")
 
-        # Enable streaming
-        self.recognizer.enable_streaming()
+        # The recognizer is shared, so only one segment is recognized at a time
+        self.lock = threading.Lock()
+        # Most segments to run through the model in one pass
+        self.max_batch = max_batch
+
+        if warm_up:
+            self.warmUp()
+        self.load_seconds = time.perf_counter() - start
+
+    def warmUp(self, sampling_rate=16000):
+        # The first recognition is slow, as the model sets itself up - so do it on a bit of silence
+        start = time.perf_counter()
+        try:
+            self.recognizeBatch([np.zeros(sampling_rate, dtype=np.int16)], sampling_rate)
+        except Exception as e:
+            logger.debug("Warm-up recognition - " + str(e))
+        logger.debug("Warm-up took " + str(round(time.perf_counter() - start, 2)) + " seconds")
+
+    def recognizeBatch(self, segments, sampling_rate=16000):
+        """
+        Recognizes int16 speech segments, up to max_batch of them in one forward pass of the model.
+
+        The spectrograms are padded with zeros to the longest one, and the model gets the real length of each, which
+        it masks the padding in the convolutions with, and packs the sequences for the RNNs by. The decoder only looks
+        at the output steps within each length, so a segment gets the same transcription as when recognized alone.
+
+        :return: The transcriptions, in the same order as the segments.
+        """
+        transcriptions = []
+        with self.lock:
+            for start in range(0, len(segments), self.max_batch):
+                transcriptions += self.forwardBatch(segments[start:start + self.max_batch], sampling_rate)
+        return transcriptions
+
+    def forwardBatch(self, segments, sampling_rate):
+        danspeech_recognizer = self.recognizer.danspeech_recognizer
+        spectrograms = [danspeech_recognizer.audio_parser.parse_audio(
+            AudioData(segment.tobytes(), sampling_rate, 2).get_array_data()) for segment in segments]
+
+        # Packing the sequences needs them from the longest to the shortest
+        order = sorted(range(len(spectrograms)), key=lambda i: spectrograms[i].size(1), reverse=True)
+        lengths = [spectrograms[i].size(1) for i in order]
+        batch = torch.zeros(len(order), 1, spectrograms[0].size(0), lengths[0])
+        for row, i in enumerate(order):
+            batch[row, 0, :, :lengths[row]] = spectrograms[i]
+
+        with torch.no_grad():
+            out, output_sizes = danspeech_recognizer.model(batch.to(danspeech_recognizer.device),
+                                                           torch.IntTensor(lengths))
+        decoded_output, _ = danspeech_recognizer.decoder.decode(out, output_sizes)
+
+        transcriptions = [None]*len(segments)
+        for row, i in enumerate(order):
+            transcriptions[i] = decoded_output[row][0]
+        return transcriptions
+
+
+class WorkerStream:
+    """
+    The audio of one speaker in the recognition worker - the shared buffer it comes in through, and a voice activity
+    detector of its own to find the speech in it.
+    """
+    def __init__(self, buffer_name, lock, sampling_rate=16000, chunk_size=1024):
+        self.buffer = SharedRingBuffer(lock, name=buffer_name)
+        self.vad = VoiceActivityDetector(sampling_rate=sampling_rate)
+        self.chunk_size = chunk_size
+        self.flushed = True
+
+    def readSegments(self):
+        """
+        Reads all the audio that has arrived without waiting, and returns the speech segments that ended in it, and
+        whether there was any audio.
+        """
+        segments = []
+        got_audio = False
+        while True:
+            # A new array every time, since the detector keeps views of the samples from before speech starts
+            samples = self.buffer.read(self.chunk_size)
+            if samples is None:
+                break
+            got_audio = True
+            self.flushed = False
+            segments += self.vad.process(samples)
+
+        if not got_audio and self.buffer.closed and not self.flushed:
+            segments += self.flush()
+        return segments, got_audio
+
+    def flush(self):
+        # The stream has ended, so whatever was being said when it did is all there is
+        segment = self.vad.endSegment() if self.vad.in_speech else None
+        self.vad.reset()
+        self.flushed = True
+        return [segment] if segment is not None else []
+
+    def finish(self):
+        # Reads what is left before the stream is closed
+        segments, _ = self.readSegments()
+        if not self.flushed:
+            segments += self.flush()
+        self.buffer.release()
+        return segments
+
+
+def runRecognitionWorker(connection, lock, sampling_rate=16000, poll_interval=0.01):
+    """
+    Main function of the process started by :class:`RecognitionWorker`.
+
+    Loads the models, then finds the speech in the audio of all the open streams and sends the transcriptions back
+    over the connection, until it gets "stop" or the other end goes away. Speech that ends on several streams while
+    the model is busy is recognized together in one batch.
+    """
+    try:
+        models = SpeechModels()
+    except Exception as e:
+        connection.send(("error", str(e)))
+        return
+    connection.send(("ready", models.load_seconds))
+
+    streams = {}
+    try:
+        while True:
+            # (stream name, segment) for all the speech that has ended since the last batch
+            pending = []
+            closed = []
+
+            # Raises EOFError if the main process has gone away
+            while connection.poll():
+                message = connection.recv()
+                if message == "stop":
+                    return
+                if message[0] == "open":
+                    streams[message[1]] = WorkerStream(message[1], lock, sampling_rate)
+                elif message[0] == "close" and message[1] in streams:
+                    pending += [(message[1], segment) for segment in streams.pop(message[1]).finish()]
+                    closed.append(message[1])
+
+            got_audio = False
+            for name, stream in streams.items():
+                segments, stream_got_audio = stream.readSegments()
+                pending += [(name, segment) for segment in segments]
+                got_audio = got_audio or stream_got_audio
+
+            if pending:
+                start = time.perf_counter()
+                transcriptions = models.recognizeBatch([segment for _, segment in pending], sampling_rate)
+                logger.debug("Recognized " + str(len(pending)) + " segment(s) with " +
+                             str(round(sum(len(segment) for _, segment in pending)/sampling_rate, 2)) +
+                             " seconds of speech in " + str(round(time.perf_counter() - start, 2)) + " seconds")
+                for (name, _), transcription in zip(pending, transcriptions):
+                    connection.send(("transcript", name, transcription))
+            elif not got_audio:
+                time.sleep(poll_interval)
+
+            # After their last transcriptions
+            for name in closed:
+                connection.send(("closed", name))
+    except (EOFError, BrokenPipeError):
+        pass
+    finally:
+        for stream in streams.values():
+            stream.buffer.release()
+
+
+class RecognitionWorker:
+    """
+    Runs the speech recognition for every speaker in one process of its own.
+
+    The model takes hundreds of milliseconds of CPU per utterance, and while it runs in the main process it holds the
+    GIL away from the event loop running the webapp, WebRTC and the motors. Every speaker gets a stream from
+    :meth:`openStream`, which is a :class:`SharedRingBuffer` that a :class:`TrackStream` can write to. The
+    transcriptions are sent back over a pipe, which is read on a thread of its own and handed to the event loop - the
+    Proactor event loop on Windows can not watch a pipe with add_reader. The worker has one copy of the model, and
+    recognizes the utterances of speakers talking at the same time in one batch.
+
+    The worker is spawned, so it imports the main module again - that must not have side effects outside of
+    ``if __name__ == "__main__":``, like opening log files.
+    """
+    def __init__(self, sampling_rate=16000, buffer_seconds=10):
+        self.sampling_rate = sampling_rate
+        self.buffer_seconds = buffer_seconds
+        # Spawned, since forking would copy the threads of the main process in a random state
+        context = multiprocessing.get_context("spawn")
+        self.connection, self.worker_connection = context.Pipe()
+        # Guards the shared buffers of all the streams - it can only be given to the worker when it is started
+        self.lock = context.Lock()
+        self.process = context.Process(target=runRecognitionWorker,
+                                       args=(self.worker_connection, self.lock, sampling_rate), daemon=True)
+        self.receiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="RecognitionWorker")
+        self.stopping = False
+        self.loop = None
+        self.ready = None
+        self.load_seconds = None
+        # Buffer name -> (buffer, on_transcript) for the open streams
+        self.streams = {}
+        self.closing = set()
+
+    def start(self):
+        """
+        Starts the process, which then loads the models.
+
+        :return: Future which is done once the models are loaded.
+        """
+        self.loop = asyncio.get_event_loop()
+        self.ready = self.loop.create_future()
+        self.process.start()
+        # Only the worker should have its end open, so reading gets EOFError if the worker dies
+        self.worker_connection.close()
+        self.loop.run_in_executor(self.receiver, self.receive)
+        return self.ready
+
+    def openStream(self, on_transcript):
+        """
+        Opens a stream for the audio of one speaker.
+
+        :param on_transcript: Called on the event loop with every transcription of the stream.
+        :return: The SharedRingBuffer to write the audio to.
+        """
+        buffer = SharedRingBuffer(self.lock, self.sampling_rate*self.buffer_seconds)
+        self.streams[buffer.name] = (buffer, on_transcript)
+        self.connection.send(("open", buffer.name))
+        return buffer
+
+    def closeStream(self, buffer: SharedRingBuffer):
+        # The audio already in the buffer is still recognized, and the buffer is released once the worker is done
+        if buffer.name not in self.streams or buffer.name in self.closing:
+            return
+        self.closing.add(buffer.name)
+        try:
+            self.connection.send(("close", buffer.name))
+        except (BrokenPipeError, OSError):
+            self.releaseStream(buffer.name)
+
+    def releaseStream(self, name):
+        self.closing.discard(name)
+        if name in self.streams:
+            buffer, _ = self.streams.pop(name)
+            buffer.release()
+
+    def receive(self):
+        # Runs on the receiver thread until the worker has gone
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                self.callOnLoop(self.workerStopped)
+                return
+            self.callOnLoop(self.handle, message)
+
+    def callOnLoop(self, callback, *args):
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The event loop has been closed
+            pass
+
+    def workerStopped(self):
+        if not self.stopping:
+            logger.error("The recognition worker has stopped")
+        if not self.ready.done():
+            self.ready.set_exception(RuntimeError("The recognition worker stopped while loading"))
+
+    def handle(self, message):
+        if message[0] == "ready":
+            self.load_seconds = message[1]
+            if not self.ready.done():
+                self.ready.set_result(self)
+        elif message[0] == "transcript":
+            if message[1] in self.streams:
+                self.streams[message[1]][1](message[2])
+        elif message[0] == "closed":
+            self.releaseStream(message[1])
+        elif message[0] == "error":
+            logger.error("Recognition worker error - " + message[1])
+            if not self.ready.done():
+                self.ready.set_exception(RuntimeError(message[1]))
+
+    def stop(self, timeout=2):
+        self.stopping = True
+        if self.process.is_alive():
+            try:
+                self.connection.send("stop")
+            except (BrokenPipeError, OSError):
+                pass
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join(timeout)
+        # The receiver gets EOFError once the worker has gone, and has to be done with the pipe before it is closed
+        self.receiver.shutdown(wait=True)
+        self.connection.close()
+        for name in list(self.streams):
+            self.releaseStream(name)
+
+
+class DanSpeecher():
+    def __init__(self, mic: SpeechSource, vad: VoiceActivityDetector = None, models: SpeechModels = None):
+        # Variables
+        self.transcribing = False
+
+        # Init a microphone object
+        self.m = mic
+
+        # The shared models, or new ones if there are none
+        self.models = models if models else SpeechModels()
+        self.model = self.models.model
+        self.recognizer = self.models.recognizer
+        self.lm = self.models.lm
+
+        # Voice activity detection - only speech segments are passed on to the model
+        self.vad = vad if vad else VoiceActivityDetector(sampling_rate=mic.sampling_rate)
 
         # Generator
         self.generator = None
@@ -788,18 +1568,37 @@ class DanSpeecher():
         logger.info("Speak a lot to adjust silence detection from microphone...")
         with self.m as source:
             self.recognizer.adjust_for_speech(source, duration=5)
+        self.vad.energy_threshold = self.recognizer.energy_threshold
+        self.vad.min_energy_threshold = self.recognizer.energy_threshold
 
     def createGenerator(self):
-        # Create the streaming generator which runs a background thread listening to the microphone stream
-        try:
-            self.generator = self.recognizer.streaming(source=self.m)
-        except Exception as e:
-            logger.error("bbbb - " + str(e))
+        # Create the generator which reads from the microphone stream, and transcribes the speech segments
+        self.generator = self.streaming()
+
+    def streaming(self):
+        with self.m as source:
+            while True:
+                buffer = source.stream.read(source.chunk)
+                # Reached the end of the stream
+                if len(buffer) == 0:
+                    break
+
+                for segment in self.vad.process(np.frombuffer(buffer, dtype=np.int16)):
+                    logger.debug("Speech segment of " + str(len(segment)/source.sampling_rate) + " seconds - " +
+                                 str(self.vad.segments) + " segments, " + str(self.vad.speech_frames) + "/" +
+                                 str(self.vad.total_frames) + " frames were speech")
+                    with self.models.lock:
+                        transcription = self.recognizer.recognize(
+                            self.recognizer.get_audio_data([segment.tobytes()], source))
+                    yield transcription
 
     def get_transcription(self):
         logger.debug("get_transcription")
         try:
             return next(self.generator)
+        except StopIteration:
+            logger.info("Audio stream ended - stopping transcriber")
+            self.transcribing = False
         except Exception as e:
             logger.error("error getting transcription - " + str(e))
 
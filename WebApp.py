@@ -1,26 +1,153 @@
 import argparse
+import asyncio
+import gzip
+import hashlib
 import logging
 import os
 import ssl
 from aiohttp import web
 import WebRTCManager
 
-ROOT = os.path.dirname(__file__)
-
-
-async def index(request):
-    content = open(os.path.join(ROOT, "public/index.html"), "r").read()
-    return web.Response(content_type="text/html", text=content)
-
-
-async def javascript(request):
-    content = open(os.path.join(ROOT, "public/client.js"), "r").read()
-    return web.Response(content_type="application/javascript", text=content)
+# Brotli is optional - without it the assets are only gzipped
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-
-async def css(request):
-    content = open(os.path.join(ROOT, "public/stylesheet.css"), "r").read()
-    return web.Response(content_type="text/css", text=content)
+ROOT = os.path.dirname(__file__)
+logger = logging.getLogger("WebApp")
+
+# The files of the client, by the path they are served at
+PUBLIC_FILES = {"/": ("public/index.html", "text/html"),
+                "/client.js": ("public/client.js", "application/javascript"),
+                "/stylesheet.css": ("public/stylesheet.css", "text/css")}
+
+
+class StaticAsset:
+    """
+    A file that is served from memory, compressed ahead of time with every encoding that makes it smaller.
+    """
+    # Files smaller than this are not worth compressing
+    MIN_COMPRESS_SIZE = 256
+
+    def __init__(self, path, content_type):
+        self.path = path
+        self.content_type = content_type
+        self.mtime = None
+        self.etag = None
+        # Content and ETag by content encoding, "identity" being uncompressed
+        self.encodings = {}
+        self.load()
+
+    def load(self):
+        with open(self.path, "rb") as file:
+            content = file.read()
+        self.mtime = os.stat(self.path).st_mtime
+
+        digest = hashlib.sha1(content).hexdigest()[:16]
+        self.etag = '"' + digest + '"'
+        self.encodings = {"identity": (content, self.etag)}
+        if len(content) >= self.MIN_COMPRESS_SIZE:
+            compressed = {"gzip": gzip.compress(content, compresslevel=9)}
+            if brotli:
+                compressed["br"] = brotli.compress(content)
+            for encoding, data in compressed.items():
+                if len(data) < len(content):
+                    # Every encoding is a different response, so it gets its own ETag
+                    self.encodings[encoding] = (data, '"' + digest + "-" + encoding + '"')
+
+    def isModified(self):
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return False
+
+    def chooseEncoding(self, accept_encoding):
+        # The smallest encoding that the client accepts - brotli, then gzip, then none
+        accepted = set()
+        for value in accept_encoding.split(","):
+            encoding, _, parameters = value.partition(";")
+            # "gzip;q=0" means anything but gzip
+            if parameters.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue
+            accepted.add(encoding.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in self.encodings and encoding in accepted:
+                return encoding
+        return "identity"
+
+    def matches(self, if_none_match):
+        # Whether the client already has this file, from any of the ETags in If-None-Match
+        if not if_none_match:
+            return False
+        etags = {etag for _, etag in self.encodings.values()}
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return True
+            # Weak comparison, as proxies may weaken the ETag
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag in etags:
+                return True
+        return False
+
+
+class StaticAssets:
+    """
+    Serves the files of the client from memory. Everything is read and compressed once at startup, and responses
+    have an ETag, so browsers can revalidate their cached copy and get a 304 without the file being sent again.
+
+    With watch, the files are checked for changes every watch_interval seconds and reloaded, for development.
+    """
+    def __init__(self, files: dict, root=ROOT, cache_control="no-cache", watch=False, watch_interval=1.0):
+        self.assets = {route: StaticAsset(os.path.join(root, path), content_type)
+                       for route, (path, content_type) in files.items()}
+        self.cache_control = cache_control
+        self.watch = watch
+        self.watch_interval = watch_interval
+        self.watcher = None
+
+    def addRoutes(self, app: web.Application):
+        for route in self.assets:
+            app.router.add_get(route, self.handle)
+        if self.watch:
+            app.on_startup.append(self.startWatching)
+            app.on_cleanup.append(self.stopWatching)
+
+    async def handle(self, request):
+        asset = self.assets[request.match_info.route.resource.canonical]
+        encoding = asset.chooseEncoding(request.headers.get("Accept-Encoding", ""))
+        content, etag = asset.encodings[encoding]
+        headers = {"Cache-Control": self.cache_control, "Vary": "Accept-Encoding", "ETag": etag}
+
+        if asset.matches(request.headers.get("If-None-Match")):
+            return web.Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return web.Response(body=content, content_type=asset.content_type, charset="utf-8", headers=headers)
+
+    def reloadModified(self):
+        for asset in self.assets.values():
+            if asset.isModified():
+                logger.info("Reloading " + asset.path)
+                try:
+                    asset.load()
+                except OSError as e:
+                    logger.error("Could not reload " + asset.path + ": " + str(e))
+
+    async def watchFiles(self):
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            self.reloadModified()
+
+    async def startWatching(self, app):
+        self.watcher = asyncio.ensure_future(self.watchFiles())
+
+    async def stopWatching(self, app):
+        if self.watcher:
+            self.watcher.cancel()
 
 
 async def offer(request):
@@ -32,6 +159,10 @@ async def offer(request):
     )
 
 
+async def on_startup(app):
+    await WebRTCManager.on_startup()
+
+
 async def on_shutdown(app):
     await WebRTCManager.on_shutdown()
 
@@ -49,10 +180,9 @@ def start_app(args):
         ssl_context = None
 
     app = web.Application()
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
-    app.router.add_get("/", index)
-    app.router.add_get("/client.js", javascript)
-    app.router.add_get("/stylesheet.css", css)
+    StaticAssets(PUBLIC_FILES, watch=getattr(args, "reload", False)).addRoutes(app)
     app.router.add_post("/offer", offer)
     web.run_app(
         app, access_log=None, host=args.host, port=args.port, ssl_context=ssl_context
@@ -73,6 +203,7 @@ if __name__ == "__main__":
     )
     parser.add_argument("--record-to", help="Write received media to a file."),
     parser.add_argument("--verbose", "-v", action="count")
+    parser.add_argument("--reload", action="store_true", help="Reload the files in public/ when they change")
     args = parser.parse_args()
 
     start_app(args)
@@ -1,17 +1,16 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import importlib
 import json
 import logging
+import math
 import os
 import re
 import subprocess
-import threading
 import uuid
 import platform
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.contrib.media import MediaPlayer, MediaRelay
 from pyee import AsyncIOEventEmitter
-import SpeechManager
 
 ROOT = os.path.dirname(__file__)
 
@@ -25,8 +24,55 @@ enableOnBoardSpeechRecognizion = False
 
 audio = None
 video = None
-client_audio = None
-danspeecher = None
+
+# The speech stack (DanSpeech, PyAudio, av) takes long to import, so it is only imported when on board speech
+# recognition is used - see loadSpeechManager
+SpeechManager = None
+
+
+async def loadSpeechManager():
+    # Imports the SpeechManager on another thread, so the event loop keeps running meanwhile
+    global SpeechManager
+    if SpeechManager is None:
+        loop = asyncio.get_event_loop()
+        SpeechManager = await loop.run_in_executor(None, importlib.import_module, "SpeechManager")
+    return SpeechManager
+
+
+# Future for the recognition worker, which is started once and shared by every connection - see warmUpSpeech
+speech_worker = None
+
+
+async def startSpeechWorker():
+    speech_manager = await loadSpeechManager()
+    worker = speech_manager.RecognitionWorker()
+    try:
+        await worker.start()
+    except Exception:
+        worker.stop()
+        raise
+    logger.info("Speech models loaded in the recognition worker in %.1f seconds", worker.load_seconds)
+    return worker
+
+
+def warmUpSpeech():
+    """
+    Starts the recognition worker, which loads the speech models, if it is not already starting or started.
+
+    :return: The future the worker is ready in - shared, so await it with asyncio.shield.
+    """
+    global speech_worker
+    # exception() raises if the future was cancelled, so check that first
+    if speech_worker is None or speech_worker.cancelled() or (speech_worker.done() and speech_worker.exception()):
+        speech_worker = asyncio.ensure_future(startSpeechWorker())
+    return speech_worker
+
+
+async def on_startup():
+    # Load the models while waiting for the first connection, instead of when it comes
+    if enableOnBoardSpeechRecognizion:
+        logger.info("Starting the recognition worker")
+        warmUpSpeech()
 
 
 def init(log_level):
@@ -117,6 +163,10 @@ async def offer(request):
 
     log_info("Created for %s", request.remote)
 
+    # The audio from this peer, and the stream it is sent to the recognition worker in
+    client_audio = None
+    speech_buffer = None
+
     # recorder = MediaRecorder("./temp_media/temp_audio.wav")
 
     @pc.on("datachannel")
@@ -130,9 +180,28 @@ async def offer(request):
                     command = message[9:].strip()
                     logger.info("Command received: " + command)
                     RTCMessage.emit("command", command)
+                elif message.startswith("vel "):
+                    # "vel <linear> <angular>" - sent many times a second, so it is not logged
+                    try:
+                        linear, angular = (float(value) for value in message[4:].split())
+                    except ValueError:
+                        logger.error("Invalid velocity: " + message)
+                        return
+                    # float() also takes "nan" and "inf", which the motors and servo can not do anything with
+                    if not (math.isfinite(linear) and math.isfinite(angular)):
+                        logger.error("Invalid velocity: " + message)
+                        return
+                    RTCMessage.emit("velocity", linear, angular)
+
+    def stopSpeechRecognizion():
+        nonlocal speech_buffer
+        if speech_buffer:
+            speech_worker.result().closeStream(speech_buffer)
+            speech_buffer = None
 
     async def close():
         global pcs
+        stopSpeechRecognizion()
         if pc in pcs:
             pcs.discard(pc)
             await pc.close()
@@ -152,67 +221,34 @@ async def offer(request):
                     logger.info(str(e))
                 players.remove(player)
 
+    def on_transcript(transcription):
+        log_info("Transcription: %s", transcription)
+        if transcription:
+            RTCMessage.emit("command", transcription)
+
     async def speechRecognizion(track):
-        global danspeecher
-        if not danspeecher:
-            log_info("Creating danspeecher")
-                # loop.run_in_executor(executor, speechRecognizion, client_audio)
-
-                # loop = asyncio.new_event_loop()
-                # asyncio.set_event_loop(loop)
-            logger.debug("trackstream")
-            trackStream = SpeechManager.TrackStream(track)
-            await trackStream.intializeStream()
-            # Run on another thread - so we can continue
-            asyncio.ensure_future(trackStream.writeToStream())
-                # Run on another thread - so we can continue
-                # threading.Thread(target=sendAudio, args=(client_audio, stream), daemon=True)
-                # loop.run_in_executor(pool, sendAudio, client_audio, stream)
-                # loop.run_in_executor(executor, asyncio.ensure_future, sendAudio(client_audio, stream))
-                # executor.submit(sendAudio, client_audio, stream)
-
-            await asyncio.sleep(1)
-            logger.debug("micsetup")
-            mic = SpeechManager.MicInput(sampling_rate=trackStream.samp_rate, pyaudio_stream=trackStream.stream)
-
-            def doDanSpeecher():
-                danSpeecher = SpeechManager.DanSpeecher(mic=mic)
-                # danSpeecher.adjust()
-                # danSpeecher.createGenerator()
-                # danSpeecher.startTranscriber(RTCMessage)
-
-                t1 = threading.Thread(target=danSpeecher.adjust, daemon=True)
-                logger.debug("running adjuster task")
-                t1.start()
-                t1.join()
-                t2 = threading.Thread(target=danSpeecher.createGenerator, daemon=True)
-                logger.debug("running generator task")
-                t2.start()
-                t2.join()
-                t3 = threading.Thread(target=danSpeecher.startTranscriber, args=(RTCMessage,), daemon=True)
-                logger.debug("running transcriber task")
-                t3.start()
-
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                loop = asyncio.get_event_loop()
-                await loop.run_in_executor(executor, doDanSpeecher)
-
-
-
-            # executor = ProcessPoolExecutor(2)
-            #     danspeecherFuture = asyncio.ensure_future(loop.run_in_executor(executor, SpeechManager.DanSpeecher, mic))
-
-                # danSpeecher = await newloop.run_in_executor(executor, SpeechManager.DanSpeecher, mic)
-                # danSpeecher = await asyncio.wait([SpeechManager.DanSpeecher(mic=mic)])
-                # danSpeecher = SpeechManager.DanSpeecher(mic=mic)
-                # await danSpeecher.adjust()
-                # await danSpeecher.createGenerator()
-                # await danSpeecher.startTranscriber(RTCMessage)
-
-                # Run on another thread - so we can continue
-                # newloop.run_in_executor(executor, danSpeecher.startTranscriber, RTCMessage)
-            # threading.Thread(target=danspeecher.startTranscriber, args=(RTCMessage,), daemon=True)
-            # danspeecher.startTranscriber(RTCMessage)
+        nonlocal speech_buffer
+        # Every peer gets its own stream in the recognition worker, which recognizes them all with one model
+        if speech_buffer:
+            return
+        log_info("Sending audio to the recognition worker")
+        try:
+            worker = await asyncio.shield(warmUpSpeech())
+        except Exception as e:
+            logger.error("Could not start the recognition worker - " + str(e))
+            return
+        # The peer may have gone while the worker was starting, and then nothing would close the stream
+        if pc not in pcs or pc.connectionState in ("closed", "failed") or track.readyState == "ended":
+            log_info("Gone before the recognition worker was ready")
+            return
+        # Or the track has been connected again meanwhile, and already has a stream
+        if speech_buffer:
+            return
+        speech_buffer = worker.openStream(on_transcript)
+        trackStream = SpeechManager.TrackStream(track, buffer=speech_buffer)
+        await trackStream.intializeStream()
+        # Run on another thread - so we can continue
+        asyncio.ensure_future(trackStream.writeToStream())
 
     @pc.on("connectionstatechange")
     async def on_connectionstatechange():
@@ -222,8 +258,7 @@ async def offer(request):
         if pc.connectionState == "connected":
             if client_audio:
                 if enableOnBoardSpeechRecognizion:
-                    if not danspeecher:
-                        await speechRecognizion(client_audio)
+                    await speechRecognizion(client_audio)
                 else:
                     logger.info("On board speech recognition is disabled.")
 
@@ -239,12 +274,14 @@ async def offer(request):
         log_info("Track %s received", track.kind)
 
         if track.kind == "audio":
-            global client_audio
+            nonlocal client_audio
             client_audio = track
 
         @track.on("ended")
         async def on_ended():
             log_info("Track %s ended", track.kind)
+            if track is client_audio:
+                stopSpeechRecognizion()
 
     # handle offer
     await pc.setRemoteDescription(offer)
@@ -267,6 +304,5 @@ async def on_shutdown():
     await asyncio.gather(*coros)
     pcs.clear()
 
-    global danspeecher
-    if danspeecher:
-        danspeecher.stop()
+    if speech_worker and speech_worker.done() and not speech_worker.cancelled() and not speech_worker.exception():
+        speech_worker.result().stop()
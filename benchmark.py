@@ -0,0 +1,706 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import numpy as np
+
+
+class Timer:
+    # Measures both wall time and CPU time of the process, to get a CPU usage percentage
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wall = time.perf_counter() - self.wall_start
+        self.cpu = time.process_time() - self.cpu_start
+
+    def cpuPercent(self, audio_seconds):
+        # CPU time spent per second of audio, which is the CPU usage when running in real time
+        return self.cpu/audio_seconds*100
+
+
+def printResult(name, frames, timer: Timer, audio_seconds):
+    print("{:<24} {:>12.0f} frames/sec {:>8.2f} % CPU (real time)".format(name, frames/timer.wall,
+                                                                         timer.cpuPercent(audio_seconds)))
+
+
+def syntheticFrames(count, sample_rate=48000, channels=2, samples=960):
+    # Stereo int16 frames like the ones aiortc decodes from opus - a tone with a bit of noise
+    t = np.arange(count*samples)/sample_rate
+    signal = np.sin(2*np.pi*440*t)*8000 + np.random.default_rng(0).normal(0, 500, len(t))
+    interleaved = np.repeat(signal.astype(np.int16), channels)
+    return interleaved.reshape(count, samples*channels)
+
+
+def benchResample(args):
+    import SpeechManager
+
+    frames = syntheticFrames(args.frames)
+    audio_seconds = args.frames*960/48000
+
+    resampler = SpeechManager.Resampler(48000, 16000, channels=2)
+    with Timer() as timer:
+        for frame in frames:
+            resampler.process(frame)
+    printResult("Resampler", args.frames, timer, audio_seconds)
+
+    try:
+        import librosa
+    except ImportError:
+        print("librosa is not installed - skipping the old resampling path")
+        return
+
+    # The old path from TrackStream.writeToBuffer
+    with Timer() as timer:
+        for frame in frames:
+            re_sampled = librosa.resample(frame.astype(dtype='float32'), orig_sr=48000, target_sr=16000,
+                                         res_type='zero_order_hold')
+            re_sampled[::2].astype(dtype='int16')
+    printResult("librosa zero_order_hold", args.frames, timer, audio_seconds)
+
+
+# Transcripts like the ones we get from DanSpeech
+PARSER_CORPUS = ["to frem", "frem", "stop", "tre meter tilbage", "to frem og tre frem", "drej til højre",
+                 "kør fem centimeter frem og så til venstre", "ti centimeter baglæns", "en meter frem stop",
+                 "kør frem to meter og drej til højre og kør tilbage tre meter", "venstre venstre",
+                 "fire millimeter bagud", "kør lige en halv meter frem", "to tre fire frem", "højre og så stop",
+                 "syv centimeter frem og så otte centimeter tilbage og så højre og så venstre og så stop",
+                 "frem frem frem", "meter to frem centimeter", "kør tyve centimeter frem hurtigt", ""]
+
+
+def legacyTextToCommands(text, logger):
+    # The old parser as it was, from before the vocabulary was compiled - with its keywords made on every call, and
+    # returning the dicts the Commands were made from
+    command_keywords = {"stop": 0,
+                        "frem": 1,  # "kør": 1,
+                        "tilbage": -1, "baglæns": -1, "bagud": -1,
+                        "højre": 2,
+                        "venstre": 3}
+    distance_keywords = {"millimeter": 0.1, "centimeter": 1,
+                         "meter": 100}
+    number_keywords = {"en": 1, "1": 1,
+                       "to": 2, "2": 2,
+                       "tre": 3, "3": 3,
+                       "fire": 4,
+                       "fem": 5,
+                       "seks": 6,
+                       "syv": 7,
+                       "otte": 8,
+                       "ni": 9,
+                       "ti": 10,
+                       "elleve": 11,
+                       "tolv": 12,
+                       "tretten": 13,
+                       "fjorten": 14,
+                       "femten": 15,
+                       "seksten": 16,
+                       "sytten": 17,
+                       "atten": 18,
+                       "nitten": 19,
+                       "tyve": 20}
+
+    commands = []
+    text_list = text.split(" ")
+
+    i = 0
+    while True:
+        if i >= len(text_list):
+            break
+
+        current_word = text_list[i].lower()
+        if current_word in command_keywords:
+            logger.debug(text_list)
+            logger.debug("Current i: " + str(i) + " - " + str(current_word))
+            if command_keywords[current_word] == 0 or command_keywords[current_word] == 100:
+                commands.append({"command": command_keywords[current_word], "word": current_word})
+                text_list.pop(i)
+                continue
+
+            command = {"command": command_keywords[current_word], "word": current_word,
+                       "distance": 100, "distance_word": None,
+                       "number": 1, "number_word": None}
+
+            def searchAround(keyword_list: dict, max_search: int = 2, negative=False):
+                for y in range(1, max_search + 1):
+                    number = None
+                    if negative and (i - y) >= 0:
+                        number = i - y
+                    elif not negative and (i + y) < len(text_list):
+                        number = i + y
+
+                    if isinstance(number, int):
+                        current_word = text_list[number].lower()
+                        if current_word in command_keywords:
+                            continue
+                        if current_word in keyword_list:
+                            text_list.pop(number)
+                            return current_word
+                return None
+
+            search_word = searchAround(distance_keywords, negative=True)
+            if search_word:
+                command["distance"] = distance_keywords[search_word]
+                command["distance_word"] = search_word
+                i -= 1
+            else:
+                search_word = searchAround(distance_keywords, negative=False)
+                if search_word:
+                    command["distance"] = distance_keywords[search_word]
+                    command["distance_word"] = search_word
+            search_word = searchAround(number_keywords, negative=True)
+            if search_word:
+                command["number"] = number_keywords[search_word]
+                command["number_word"] = search_word
+                i -= 1
+            else:
+                search_word = searchAround(number_keywords, negative=False)
+                if search_word:
+                    command["number"] = number_keywords[search_word]
+                    command["number_word"] = search_word
+
+            commands.append(command)
+            text_list.pop(i)
+        i += 1
+    return commands
+
+
+def commandKey(command):
+    words = command.debug_words
+    return (command.command, command.distance, command.number,
+            words["commandWord"], words["distanceWord"], words["numberWord"])
+
+
+def benchParser(args):
+    import CommandManager
+
+    # Logging would take up most of the time
+    CommandManager.logger.disabled = True
+
+    def legacyParse(text):
+        # With the logging the old CommandParser did around it
+        CommandManager.logger.debug("Raw text command: " + text)
+        commands = [CommandManager.Command(command) for command in legacyTextToCommands(text, CommandManager.logger)]
+        CommandManager.logger.debug("Commands: " + str(commands))
+        return commands
+
+    differences = 0
+    for text in PARSER_CORPUS:
+        new = [commandKey(command) for command in CommandManager.CommandParser(text).commands]
+        old = [commandKey(command) for command in legacyParse(text)]
+        if new != old:
+            differences += 1
+            print("Different output for \"" + text + "\":")
+            print("  old: " + str(old))
+            print("  new: " + str(new))
+    # CommandParser knows more words, like "halv", "hundrede" or misheard keywords, and reads numbers of several words
+    # as one number, so some differences are expected
+    print("Transcripts with different output: " + str(differences) + "/" + str(len(PARSER_CORPUS)))
+
+    def timeParsers(corpus, repeat):
+        with Timer() as old_timer:
+            for _ in range(repeat):
+                for text in corpus:
+                    legacyParse(text)
+        with Timer() as new_timer:
+            for _ in range(repeat):
+                for text in corpus:
+                    CommandManager.CommandParser(text)
+
+        transcripts = repeat*len(corpus)
+        print("{:<24} {:>12.0f} transcripts/sec".format("Old parser", transcripts/old_timer.wall))
+        print("{:<24} {:>12.0f} transcripts/sec".format("CommandParser", transcripts/new_timer.wall))
+        print("Speedup: {:.2f}x".format(old_timer.wall/new_timer.wall))
+
+    print("Corpus:")
+    timeParsers(PARSER_CORPUS, args.repeat)
+
+    # One long transcript, where the old parser's popping from the word list adds up
+    long_text = " og ".join(PARSER_CORPUS*20)
+    print("Long transcript (" + str(len(long_text.split(" "))) + " words):")
+    timeParsers([long_text], max(1, args.repeat//100))
+
+
+# Commands like the ones the robot gets from the speech recognition
+PIPELINE_COMMANDS = ["fem centimeter frem", "ti centimeter tilbage", "højre", "venstre", "to centimeter frem",
+                     "tre centimeter tilbage"]
+
+
+def createSimulatedRobot(args):
+    # A robot on a simulation, set up as main's robot, and a list that gets the motor starts before the servo was done
+    import RobotManager
+    import SimulationManager
+    import main
+
+    robot = RobotManager.Robot(leftDC_args=main.LEFT_DC_ARGS, rightDC_args=main.RIGHT_DC_ARGS,
+                               servo_args=main.SERVO_ARGS, pin_factory=SimulationManager.createPinFactory())
+    simulation = SimulationManager.Simulation(robot, motor_speed=args.motor_speed,
+                                              servo_slew_rate=args.servo_slew_rate)
+    simulation.start()
+    main.robot = robot
+
+    # Check that the wheels never start before the servo has gotten where it is going
+    unsettled_starts = []
+    motors_started = robot.motorsStarted
+
+    def motorsStarted():
+        if not simulation.servo.is_settled():
+            unsettled_starts.append(simulation.servo.angle)
+        motors_started()
+    robot.motorsStarted = motorsStarted
+
+    return robot, simulation, unsettled_starts
+
+
+async def runCommand(robot, text):
+    # Sends a command the same way a command from the data channel goes through main, and waits until it is done
+    import main
+
+    main.RTCMessage.emit("command", text)
+    await asyncio.sleep(0)
+    while robot.queue.queue or robot.current_command:
+        await asyncio.sleep(0.001)
+
+
+def benchPipeline(args):
+    import CommandManager
+    import main
+
+    robot, simulation, unsettled_starts = createSimulatedRobot(args)
+
+    async def run():
+        parse_times = []
+        command_times = []
+        for i in range(args.commands):
+            text = PIPELINE_COMMANDS[i % len(PIPELINE_COMMANDS)]
+
+            with Timer() as timer:
+                CommandManager.CommandParser(text)
+            parse_times.append(timer.wall*1000)
+
+            start = time.perf_counter()
+            await runCommand(robot, text)
+            command_times.append((time.perf_counter() - start)*1000)
+
+        print("Commands:              " + str(args.commands))
+        print("Parse time:            {:.3f} ms mean".format(sum(parse_times)/len(parse_times)))
+        print("Command time:          {:.1f} ms mean, {:.1f} ms max".format(sum(command_times)/len(command_times),
+                                                                            max(command_times)))
+        print("Servo still moving:    " + str(len(unsettled_starts)) + " of " + str(args.commands) + " motor starts")
+        latency = robot.start_latency.summary()
+        print("Enqueue to motor:      {:.2f} ms mean, {:.2f} ms median, {:.2f} ms max".format(
+            latency["mean"], latency["median"], latency["max"]))
+
+        # Stops in the middle of a long drive
+        for _ in range(args.stops):
+            main.RTCMessage.emit("command", "en meter frem")
+            await asyncio.sleep(0.1)
+            main.RTCMessage.emit("command", "stop")
+            await asyncio.sleep(0)
+            while robot.isRunning() or robot.current_command:
+                await asyncio.sleep(0.001)
+        if args.stops:
+            latency = robot.stop_latency.summary()
+            print("Stop to motors off:    {:.2f} ms mean, {:.2f} ms median, {:.2f} ms max".format(
+                latency["mean"], latency["median"], latency["max"]))
+
+    robot.loop.run_until_complete(run())
+    simulation.stop()
+
+
+# A sequence of moves said at once, so the robot knows the next command while it is running one
+SEQUENCE = "fem centimeter frem og så højre og så ti centimeter frem og så venstre og så fem centimeter tilbage"
+
+
+def benchSequence(args):
+    robot, simulation, unsettled_starts = createSimulatedRobot(args)
+    overlap = robot.servo_overlap
+
+    async def run():
+        # Without and with the servo getting ready for the next command during the end of a move
+        results = {}
+        for name, servo_overlap in (("Servo after move", 0), ("Servo overlapping", overlap)):
+            robot.servo_overlap = servo_overlap
+            unsettled_starts.clear()
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                await runCommand(robot, SEQUENCE)
+                times.append(time.perf_counter() - start)
+            results[name] = sum(times)/len(times)
+            print("{:<24} {:>8.0f} ms per sequence, servo still moving at {} motor starts".format(
+                name, results[name]*1000, len(unsettled_starts)))
+        print("Speedup: {:.2f}x".format(results["Servo after move"]/results["Servo overlapping"]))
+
+    robot.loop.run_until_complete(run())
+    simulation.stop()
+
+
+# Centimeters to drive
+MOVE_DISTANCES = [2, 5, 10, 20, 40]
+
+
+async def untilStopped(motors, still_time=0.03):
+    # Waits until the encoders have not moved for still_time seconds
+    positions = [motor.encoder.position for motor in motors]
+    still_since = time.perf_counter()
+    while time.perf_counter() - still_since < still_time:
+        await asyncio.sleep(0.002)
+        new_positions = [motor.encoder.position for motor in motors]
+        if new_positions != positions:
+            positions = new_positions
+            still_since = time.perf_counter()
+    return still_since
+
+
+def benchMoves(args):
+    robot, simulation, _ = createSimulatedRobot(args)
+    motors = (robot.leftDC, robot.rightDC)
+    ramp_time = robot.leftDC.ramp_time
+    speed = robot.leftDC.speed
+
+    async def run():
+        # Starting and stopping at full speed, and with speed profiles - which can cruise faster, as they slow down
+        # before stopping
+        for name, motor_ramp_time, motor_speed in (("Without profiles", 0, args.speed), ("With profiles", ramp_time,
+                                                                                          speed)):
+            for motor in motors:
+                motor.ramp_time = motor_ramp_time
+                motor.speed = motor_speed
+            errors = []
+            times = {distance: [] for distance in MOVE_DISTANCES}
+            for _ in range(args.repeat):
+                for distance in MOVE_DISTANCES:
+                    start = time.perf_counter()
+                    await robot.drive(distance)
+                    # The move is not over until the wheels have coasted to a stop
+                    stopped = await untilStopped(motors)
+                    times[distance].append(stopped - start)
+                    errors.extend(motor.encoder.getDistance()["cm"] - distance for motor in motors)
+            mean_times = [sum(move_times)/len(move_times)*1000 for move_times in times.values()]
+            print("{:<24} {:>6.2f} cm mean error, {:.2f} cm max, {:>6.0f} ms per move until stopped ({})".format(
+                name, sum(abs(error) for error in errors)/len(errors), max(abs(error) for error in errors),
+                sum(mean_times)/len(mean_times),
+                ", ".join("{} cm: {:.0f} ms".format(distance, mean_time)
+                          for distance, mean_time in zip(MOVE_DISTANCES, mean_times))))
+
+    robot.loop.run_until_complete(run())
+    simulation.stop()
+
+
+def benchStatic(args):
+    from aiohttp import ClientSession, TCPConnector, web
+    from aiohttp.test_utils import TestServer
+    import WebApp
+
+    def legacyHandler(path, content_type):
+        # The old handlers, which read the file on every request and sent it uncompressed
+        async def handler(request):
+            content = open(os.path.join(WebApp.ROOT, path), "r").read()
+            return web.Response(content_type=content_type, text=content)
+        return handler
+
+    legacy_app = web.Application()
+    for route, (path, content_type) in WebApp.PUBLIC_FILES.items():
+        legacy_app.router.add_get(route, legacyHandler(path, content_type))
+
+    assets_app = web.Application()
+    WebApp.StaticAssets(WebApp.PUBLIC_FILES).addRoutes(assets_app)
+
+    async def load(app, revalidate=False):
+        # Requests all the files from a number of clients at once, like browsers loading the page
+        async with TestServer(app) as server, \
+                ClientSession(connector=TCPConnector(limit=args.clients), auto_decompress=False) as session:
+            etags = {}
+            if revalidate:
+                for route in WebApp.PUBLIC_FILES:
+                    async with session.get(server.make_url(route)) as response:
+                        etags[route] = response.headers.get("ETag")
+
+            transferred = 0
+
+            async def client(requests):
+                nonlocal transferred
+                for i in range(requests):
+                    route = list(WebApp.PUBLIC_FILES)[i % len(WebApp.PUBLIC_FILES)]
+                    headers = {"Accept-Encoding": "gzip, deflate, br"}
+                    if revalidate and etags[route]:
+                        headers["If-None-Match"] = etags[route]
+                    async with session.get(server.make_url(route), headers=headers) as response:
+                        transferred += len(await response.read())
+
+            with Timer() as timer:
+                await asyncio.gather(*(client(args.requests//args.clients) for _ in range(args.clients)))
+            requests = args.requests//args.clients*args.clients
+            return requests/timer.wall, transferred/requests
+
+    async def run():
+        for name, app, revalidate in (("Read on every request", legacy_app, False),
+                                      ("StaticAssets", assets_app, False),
+                                      ("StaticAssets, cached", assets_app, True)):
+            rate, size = await load(app, revalidate)
+            print("{:<24} {:>8.0f} requests/sec {:>8.0f} bytes/request".format(name, rate, size))
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def timeToFirstResponse(command, port, timeout=300):
+    # Starts the command, and times how long it takes until the webapp answers
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError("Exited with code " + str(process.returncode) + ": " + " ".join(command))
+            try:
+                urllib.request.urlopen("http://127.0.0.1:" + str(port) + "/", timeout=1).read()
+                return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise RuntimeError("No response within " + str(timeout) + " seconds")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def benchStartup(args):
+    main_args = ["main.py", "--simulate", "--host", "127.0.0.1", "--port", str(args.port)]
+    # Before, WebRTCManager imported the SpeechManager when main started
+    eager_import = ("import sys, runpy, SpeechManager; sys.argv = " + repr(main_args) +
+                    "; runpy.run_path('main.py', run_name='__main__')")
+
+    for name, command in (("Importing SpeechManager", [sys.executable, "-c", eager_import]),
+                          ("Lazy SpeechManager", [sys.executable] + main_args)):
+        times = [timeToFirstResponse(command, args.port) for _ in range(args.repeat)]
+        print("{:<24} {:>8.2f} s to first response (min {:.2f} s)".format(name, sum(times)/len(times), min(times)))
+
+
+def speechAudio(seconds, sample_rate=16000, audio_file=None):
+    # Audio that keeps the recognizer busy - a recording on repeat, or a voice-like buzz with pauses in between
+    if audio_file:
+        import wave
+        with wave.open(audio_file) as wav:
+            if wav.getframerate() != sample_rate or wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+                raise ValueError(audio_file + " has to be 16 bit mono at " + str(sample_rate) + " Hz")
+            audio = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+        return np.resize(audio, int(seconds*sample_rate))
+
+    t = np.arange(int(seconds*sample_rate))/sample_rate
+    voice = sum(np.sin(2*np.pi*120*harmonic*t)/harmonic for harmonic in range(1, 10))*4000
+    # 1.5 seconds of "speech" and 0.8 seconds of pause
+    speaking = (t % 2.3) < 1.5
+    noise = np.random.default_rng(0).normal(0, 100, len(t))
+    return np.clip(voice*speaking + noise, -32768, 32767).astype(np.int16)
+
+
+def pingClient(connection, seconds, interval):
+    # Runs in a process of its own like the browser, so it is not held up by the GIL of the process it pings
+    latencies = []
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sent = time.perf_counter()
+        connection.send(sent)
+        connection.recv()
+        latencies.append(time.perf_counter() - sent)
+        time.sleep(interval)
+    connection.send(latencies)
+
+
+async def pingLatency(audio, write, ping_interval, sample_rate=16000, frame_samples=320):
+    """
+    Sends the audio to write in 20 ms frames in real time, like a TrackStream, while being pinged.
+
+    The data channel messages are handled on the event loop, so a ping is answered as late as the loop gets to it.
+    The pings come from another process over a pipe the event loop reads, like the data channel's socket.
+    """
+    loop = asyncio.get_event_loop()
+    context = multiprocessing.get_context("spawn")
+    connection, client_connection = context.Pipe()
+    result = loop.create_future()
+
+    def pong():
+        while connection.poll():
+            message = connection.recv()
+            if isinstance(message, list):
+                result.set_result(message)
+            else:
+                connection.send(message)
+
+    client = context.Process(target=pingClient, args=(client_connection, len(audio)/sample_rate, ping_interval))
+    client.start()
+    loop.add_reader(connection.fileno(), pong)
+    start = time.perf_counter()
+    for i in range(0, len(audio) - frame_samples + 1, frame_samples):
+        write(audio[i:i + frame_samples])
+        await asyncio.sleep(max(0.0, start + (i + frame_samples)/sample_rate - time.perf_counter()))
+    latencies = await result
+    loop.remove_reader(connection.fileno())
+    client.join()
+    return np.array(latencies)*1000
+
+
+def benchRecognition(args):
+    import SpeechManager
+
+    audio = speechAudio(args.seconds, audio_file=args.audio)
+
+    def writeAll(buffers):
+        # Every speaker says the same at the same time, so all their utterances end together
+        def write(samples):
+            for buffer in buffers:
+                buffer.write(samples)
+        return write
+
+    async def noRecognition():
+        return await pingLatency(audio, lambda samples: None, args.ping_interval), []
+
+    async def inProcess():
+        # How WebRTCManager ran it before - a DanSpeecher on a thread of the main process for every track
+        models = SpeechManager.SpeechModels()
+        transcriptions = []
+        emitter = SpeechManager.EventEmitter()
+        emitter.on("command", transcriptions.append)
+        streams = []
+        threads = []
+        for _ in range(args.speakers):
+            stream = SpeechManager.TrackStream(None)
+            speecher = SpeechManager.DanSpeecher(mic=SpeechManager.TrackSource(stream), models=models)
+            speecher.createGenerator()
+            thread = threading.Thread(target=speecher.startTranscriber, args=(emitter,), daemon=True)
+            thread.start()
+            streams.append(stream)
+            threads.append(thread)
+
+        latencies = await pingLatency(audio, writeAll([stream.buffer for stream in streams]), args.ping_interval)
+        # Closing the buffers ends the streams, and the transcribers with them
+        for stream in streams:
+            stream.buffer.close()
+        for thread in threads:
+            await asyncio.get_event_loop().run_in_executor(None, thread.join)
+        return latencies, transcriptions
+
+    async def worker():
+        transcriptions = []
+        recognition_worker = SpeechManager.RecognitionWorker()
+        await recognition_worker.start()
+        buffers = [recognition_worker.openStream(transcriptions.append) for _ in range(args.speakers)]
+        latencies = await pingLatency(audio, writeAll(buffers), args.ping_interval)
+        for buffer in buffers:
+            recognition_worker.closeStream(buffer)
+        # Time for the last utterances to come back
+        await asyncio.sleep(args.drain)
+        recognition_worker.stop()
+        return latencies, transcriptions
+
+    async def run():
+        print("{:.0f} seconds of speech from {} speaker(s), ping every {:.0f} ms".format(
+            args.seconds, args.speakers, args.ping_interval*1000))
+        for name, variant in (("No recognition", noRecognition), ("Recognition in process", inProcess),
+                              ("RecognitionWorker", worker)):
+            latencies, transcriptions = await variant()
+            print("{:<24} {:>8.1f} ms median ping {:>8.1f} ms p99 {:>8.1f} ms max {:>6} transcriptions".format(
+                name, np.median(latencies), np.percentile(latencies, 99), latencies.max(), len(transcriptions)))
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def benchBatch(args):
+    import SpeechManager
+
+    models = SpeechManager.SpeechModels()
+    audio = speechAudio(args.seconds*max(args.batch_sizes), audio_file=args.audio)
+    # Segments of a bit different lengths, like utterances from several speakers, so they have to be padded
+    length = int(args.seconds*16000)
+    segments = [audio[i*length:(i + 1)*length - i*1600] for i in range(max(args.batch_sizes))]
+
+    print("Segments of {:.1f} seconds of speech or a bit less".format(args.seconds))
+    for batch_size in args.batch_sizes:
+        batch = segments[:batch_size]
+        for name, max_batch in (("One at a time", 1), ("Batched", batch_size)):
+            models.max_batch = max_batch
+            with Timer() as timer:
+                for _ in range(args.repeat):
+                    models.recognizeBatch(batch)
+            print("{:>2} segment(s) {:<16} {:>8.0f} ms {:>8.0f} ms CPU per segment".format(
+                batch_size, name, timer.wall/args.repeat/batch_size*1000, timer.cpu/args.repeat/batch_size*1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the voice controlled robot")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    resample_parser = subparsers.add_parser("resample", help="48 kHz stereo to 16 kHz mono resampling")
+    resample_parser.add_argument("--frames", type=int, default=5000, help="Number of 20 ms frames (default: 5000)")
+    resample_parser.set_defaults(func=benchResample)
+
+    parser_parser = subparsers.add_parser("parser", help="CommandParser against the old parser")
+    parser_parser.add_argument("--repeat", type=int, default=2000, help="Times to parse the corpus (default: 2000)")
+    parser_parser.set_defaults(func=benchParser)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Commands through the whole pipeline on a simulated robot")
+    pipeline_parser.add_argument("--commands", type=int, default=30, help="Number of commands (default: 30)")
+    pipeline_parser.add_argument("--stops", type=int, default=10,
+                                 help="Number of stops during a drive (default: 10)")
+    pipeline_parser.set_defaults(func=benchPipeline)
+
+    sequence_parser = subparsers.add_parser("sequence", help="A sequence of moves on a simulated robot, with and "
+                                                             "without getting the servo ready during the moves")
+    sequence_parser.add_argument("--repeat", type=int, default=5, help="Times to run the sequence (default: 5)")
+    sequence_parser.set_defaults(func=benchSequence)
+
+    moves_parser = subparsers.add_parser("moves", help="How close drives on a simulated robot land on their distance, "
+                                                       "with and without speed profiles")
+    moves_parser.add_argument("--repeat", type=int, default=3, help="Times to drive each distance (default: 3)")
+    moves_parser.add_argument("--speed", type=float, default=0.8,
+                              help="Cruise speed without profiles, as a fraction of full power (default: 0.8)")
+    moves_parser.set_defaults(func=benchMoves)
+
+    static_parser = subparsers.add_parser("static", help="Serving the client's files, from disk and from memory")
+    static_parser.add_argument("--requests", type=int, default=3000, help="Number of requests (default: 3000)")
+    static_parser.add_argument("--clients", type=int, default=10, help="Concurrent clients (default: 10)")
+    static_parser.set_defaults(func=benchStatic)
+
+    startup_parser = subparsers.add_parser("startup", help="Time from starting main.py until the webapp answers")
+    startup_parser.add_argument("--repeat", type=int, default=3, help="Times to start it (default: 3)")
+    startup_parser.add_argument("--port", type=int, default=8080, help="Port to run the webapp on (default: 8080)")
+    startup_parser.set_defaults(func=benchStartup)
+
+    recognition_parser = subparsers.add_parser("recognition", help="Ping latency of the event loop during continuous "
+                                                                   "speech, with the recognition in process and in a "
+                                                                   "RecognitionWorker")
+    recognition_parser.add_argument("--seconds", type=float, default=30, help="Seconds of speech (default: 30)")
+    recognition_parser.add_argument("--audio", help="16 kHz mono wav file to use as the speech, on repeat "
+                                                    "(default: a synthetic voice)")
+    recognition_parser.add_argument("--ping-interval", type=float, default=0.05,
+                                    help="Seconds between pings (default: 0.05)")
+    recognition_parser.add_argument("--speakers", type=int, default=1,
+                                    help="Number of speakers talking at the same time (default: 1)")
+    recognition_parser.add_argument("--drain", type=float, default=3,
+                                    help="Seconds to wait for the last transcriptions from the worker (default: 3)")
+    recognition_parser.set_defaults(func=benchRecognition)
+
+    batch_parser = subparsers.add_parser("batch", help="Recognizing the utterances of several speakers one at a "
+                                                       "time and in one batch")
+    batch_parser.add_argument("--seconds", type=float, default=2, help="Seconds of speech per segment (default: 2)")
+    batch_parser.add_argument("--audio", help="16 kHz mono wav file to cut the segments from "
+                                              "(default: a synthetic voice)")
+    batch_parser.add_argument("--batch-sizes", type=lambda text: [int(size) for size in text.split(",")],
+                              default=[1, 2, 4, 8], help="Comma separated numbers of segments (default: 1,2,4,8)")
+    batch_parser.add_argument("--repeat", type=int, default=3, help="Times to recognize each batch (default: 3)")
+    batch_parser.set_defaults(func=benchBatch)
+
+    for simulated_parser in (pipeline_parser, sequence_parser, moves_parser):
+        simulated_parser.add_argument("--motor-speed", type=float, default=45,
+                                      help="Simulated motor speed at full power in cm/s (default: 45)")
+        simulated_parser.add_argument("--servo-slew-rate", type=float, default=300,
+                                      help="Simulated servo speed in degrees/s (default: 300)")
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,69 @@
+import argparse
+import json
+import math
+import RobotManager
+
+
+def readMotions(path):
+    """
+    Reads the moves from a motion log that have been measured. When main.py is started with --motion-log, the robot
+    writes the encoder distances of every move to the log, and after measuring how far it actually went, the
+    measurement is added to the line as "actual" - in centimeters for a drive, and degrees for a turn (right being
+    positive). Moves without it are skipped, and so are moves where the servo got ready for the next command before
+    the move was done, as the front wheel was turned for the end of them.
+    """
+    drives = []
+    turns = []
+    with open(path, encoding="UTF-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            motion = json.loads(line)
+            if "actual" not in motion or motion.get("servo_overlap"):
+                continue
+            if motion["type"] == "drive":
+                drives.append(((motion["left"] + motion["right"])/2, motion["actual"]))
+            elif motion["type"] == "turn":
+                turns.append((motion["servo_degrees"], motion["left"], motion["right"], motion["actual"]))
+    return drives, turns
+
+
+def turnErrors(model: RobotManager.TurnModel, turns):
+    # How many degrees the model is off for each turn, from the difference between the wheels
+    errors = []
+    for _, left, right, actual in turns:
+        predicted = math.degrees((left - right)*model.wheel_scale/model.track_width)
+        errors.append(predicted - actual)
+    return errors
+
+
+def printErrors(name, errors):
+    if not errors:
+        return
+    mean = sum(abs(error) for error in errors)/len(errors)
+    print("{:<24} {:>8.2f} degrees mean error, {:.2f} max".format(name, mean, max(abs(error) for error in errors)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fits the turn model of the robot to measured moves")
+    parser.add_argument("--log", default="logs/motionLog.jsonl", help="Motion log (default: logs/motionLog.jsonl)")
+    parser.add_argument("--output", default="calibration.json", help="Where to save the parameters "
+                                                                     "(default: calibration.json)")
+    args = parser.parse_args()
+
+    drives, turns = readMotions(args.log)
+    print("Measured drives: " + str(len(drives)) + ", measured turns: " + str(len(turns)))
+    if not drives and not turns:
+        print("Nothing to fit - add the measured \"actual\" distance or degrees to the moves in the log")
+        exit(1)
+
+    old_model = RobotManager.TurnModel.load(args.output)
+    model = RobotManager.TurnModel.fit(drives, turns, model=old_model)
+    print("Old parameters: " + str(old_model.toDict()))
+    print("New parameters: " + str(model.toDict()))
+    printErrors("Old parameters", turnErrors(old_model, turns))
+    printErrors("New parameters", turnErrors(model, turns))
+
+    model.save(args.output)
+    print("Saved to " + args.output)
@@ -1,12 +1,23 @@
+import argparse
 import logging
 import platform
 import CommandManager
 import RobotManager
+import SimulationManager
 import WebApp
 
 debug = False
 
 robot = None
+simulation = None
+
+# The pins of our robot - set encoder_invert for a motor whose encoder counts backwards when it drives forwards, which
+# the robot logs and stops for
+LEFT_DC_ARGS = {"motor_pos": "GPIO2", "motor_neg": "GPIO3", "encoder_a": "GPIO4", "encoder_b": "GPIO17",
+                "pwm_pin": "GPIO27", "encoder_invert": False}
+RIGHT_DC_ARGS = {"motor_pos": "GPIO22", "motor_neg": "GPIO10", "encoder_a": "GPIO9", "encoder_b": "GPIO11",
+                 "pwm_pin": "GPIO5", "encoder_invert": False}
+SERVO_ARGS = {"servo_pin": "GPIO6"}
 
 logger = logging.getLogger("Main")
 RTCMessage = WebApp.WebRTCManager.RTCMessage
@@ -26,39 +37,71 @@ async def onCommand(command):
 
     # If a robot is available
     if robot:
-        # If first command is stop in the list of commands, then run command immediately
-        if commands[0].command == 0:
-            robot.queue.empty()
-            await commands[0].run(robot)
-        else:
+        # If there is a stop in the list of commands, then run it immediately - it cancels what is running and
+        # everything before it
+        stops = [index for index, command in enumerate(commands) if command.command == 0]
+        if stops:
+            await commands[stops[-1]].run(robot)
+            commands = commands[stops[-1] + 1:]
+        if commands:
             # add commands to queue
             robot.queue.addToQueue(commands)
 
 
+# Streaming velocities from the client, like from a joystick - these skip the queue and go straight to the robot
+@RTCMessage.on("velocity")
+def onVelocity(linear, angular):
+    if robot:
+        robot.setVelocity(linear, angular)
+
+
 @RTCMessage.on("message")
 def onMessage(message):
     logger.info("Received message: " + message)
 
 
+def createRobot(simulate=False, motion_log=None):
+    # Create a robot with our pins - either on the real GPIO pins, or on mock pins driven by a simulation
+    global robot, simulation
+    pin_factory = SimulationManager.createPinFactory() if simulate else None
+    robot = RobotManager.Robot(leftDC_args=LEFT_DC_ARGS, rightDC_args=RIGHT_DC_ARGS, servo_args=SERVO_ARGS,
+                               pin_factory=pin_factory, motion_log=motion_log)
+    if simulate:
+        simulation = SimulationManager.Simulation(robot)
+        simulation.start()
+    return robot
+
+
 # Arguments for the webapp
 class WebAppArgs:
-    def __init__(self):
-        self.host = "0.0.0.0"
-        self.port = "80"
+    def __init__(self, host="0.0.0.0", port=80):
+        self.host = host
+        self.port = port
         self.cert_file = None
         self.key_file = None
         self.verbose = debug
+        # Reload the files of the client when they change, while developing
+        self.reload = debug
 
 
 if __name__ == "__main__":
-    if platform.system() == "Linux":
+    parser = argparse.ArgumentParser(description="Voice controlled robot")
+    parser.add_argument("--simulate", action="store_true", help="Use a simulated robot instead of the GPIO pins")
+    parser.add_argument("--host", default="0.0.0.0", help="Host for the webapp (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=80, help="Port for the webapp (default: 80)")
+    parser.add_argument("--motion-log", nargs="?", const="logs/motionLog.jsonl",
+                        help="Log the distances the encoders measured for every move, for calibrate.py "
+                             "(default: logs/motionLog.jsonl if no file is given)")
+    args = parser.parse_args()
+
+    CommandManager.setup_logger()
+
+    if args.simulate:
+        logger.info("Creating simulated Robot...")
+        createRobot(simulate=True, motion_log=args.motion_log)
+    elif platform.system() == "Linux":
         logger.info("Using Linux - creating Robot...")
-        # Create a robot with our pins
-        robot = RobotManager.Robot(leftDC_args={"motor_pos": "GPIO2", "motor_neg": "GPIO3",
-                                                "encoder_a": "GPIO4", "encoder_b": "GPIO17", "pwm_pin": "GPIO27"},
-                                   rightDC_args={"motor_pos": "GPIO22", "motor_neg": "GPIO10",
-                                                 "encoder_a": "GPIO9", "encoder_b": "GPIO11", "pwm_pin": "GPIO5"},
-                                   servo_args={"servo_pin": "GPIO6"})
+        createRobot(motion_log=args.motion_log)
 
     logger.info("Starting WebApp...")
-    WebApp.start_app(WebAppArgs())
+    WebApp.start_app(WebAppArgs(host=args.host, port=args.port))
@@ -316,3 +316,67 @@ function submitCommand() {
     dataChannelLog.textContent += '> command: ' + command + '\n';
     dc.send("command: " + command)
 }
+
+// Driving with the arrow keys - the velocity is streamed while a key is held, and the robot stops by itself when it
+// stops coming
+var LINEAR_SPEED = 30,  // centimeters per second
+    ANGULAR_SPEED = 90,  // degrees per second
+    VELOCITY_RATE = 20;  // messages per second
+var heldKeys = {}, velocityInterval = null;
+
+function currentVelocity() {
+    var linear = ((heldKeys['ArrowUp'] ? 1 : 0) - (heldKeys['ArrowDown'] ? 1 : 0)) * LINEAR_SPEED,
+        angular = ((heldKeys['ArrowRight'] ? 1 : 0) - (heldKeys['ArrowLeft'] ? 1 : 0)) * ANGULAR_SPEED;
+    return [linear, angular];
+}
+
+function sendVelocity() {
+    if (!dc || dc.readyState !== 'open') {
+        return;
+    }
+    var velocity = currentVelocity();
+    dc.send('vel ' + velocity[0] + ' ' + velocity[1]);
+}
+
+document.addEventListener('keydown', function(event) {
+    if (!(event.key in {'ArrowUp': 1, 'ArrowDown': 1, 'ArrowLeft': 1, 'ArrowRight': 1}) ||
+        document.activeElement === commandInput) {
+        return;
+    }
+    event.preventDefault();
+    heldKeys[event.key] = true;
+    if (!velocityInterval) {
+        sendVelocity();
+        velocityInterval = setInterval(sendVelocity, 1000 / VELOCITY_RATE);
+    }
+});
+
+document.addEventListener('keyup', function(event) {
+    if (!(event.key in heldKeys)) {
+        return;
+    }
+    delete heldKeys[event.key];
+    if (Object.keys(heldKeys).length === 0) {
+        stopVelocity();
+    }
+});
+
+function stopVelocity() {
+    heldKeys = {};
+    // Nothing to stop if the arrow keys are not driving - a stop would also end a move from a voice command
+    if (!velocityInterval) {
+        return;
+    }
+    clearInterval(velocityInterval);
+    velocityInterval = null;
+    // Stop right away instead of waiting for the watchdog
+    sendVelocity();
+}
+
+// The keyup never comes if the window loses focus while a key is held, so stop when that happens
+window.addEventListener('blur', stopVelocity);
+document.addEventListener('visibilitychange', function() {
+    if (document.hidden) {
+        stopVelocity();
+    }
+});